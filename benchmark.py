@@ -0,0 +1,623 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+import bot
+
+# Offline-Benchmarks für bot.py gegen einen lokalen Ersatz-Homeserver und eine
+# Ersatz-Messages-API. Ergebnisse werden als JSON geschrieben und lassen sich
+# mit --compare zwischen zwei Versionen vergleichen.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --output neu.json --compare results.json
+
+BOT_USER_ID = "@botport:bench.local"
+USER_ID = "@nutzer:bench.local"
+
+
+# Ersatz-Homeserver: beantwortet die Aufrufe, die der Bot macht, und zeichnet gesendete Events auf
+class FakeHomeserver:
+    def __init__(self, room_count):
+        self.room_ids = [f"!raum{i}:bench.local" for i in range(room_count)]
+        self.joined = set(self.room_ids)
+        self.media = {}
+        self.rate_limited = {}  # Raum-ID -> retry_after_ms; Senden in diese Räume antwortet mit 429
+        self.lock = threading.Lock()
+        self.sent = []
+        self.event_counter = 0
+        self.request_counts = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, name):
+        with self.lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    def sent_since(self, index):
+        with self.lock:
+            return list(self.sent[index:])
+
+    def sent_count(self):
+        with self.lock:
+            return len(self.sent)
+
+    def record_send(self, room_id, content):
+        with self.lock:
+            self.event_counter += 1
+            event_id = f"$e{self.event_counter}"
+            self.sent.append((time.monotonic(), room_id, content))
+        return event_id
+
+    def sync_response(self, since):
+        if since:
+            # Keine neuen Events; kurz warten statt eines echten Long-Polls
+            time.sleep(0.2)
+            return {"next_batch": f"s{time.monotonic()}", "rooms": {}}
+        join = {
+            room_id: {
+                "timeline": {"events": [], "prev_batch": f"p_{room_id}", "limited": False},
+                "state": {"events": []},
+            }
+            for room_id in self.joined
+        }
+        return {"next_batch": "s0", "rooms": {"join": join}}
+
+    def make_handler(self):
+        homeserver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, body, content_type="application/json"):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def read_json(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                path = unquote(parsed.path)
+                query = parse_qs(parsed.query)
+                if path.endswith("/sync"):
+                    homeserver.count("sync")
+                    self.reply(200, homeserver.sync_response(query.get("since", [None])[0]))
+                elif path.endswith("/joined_rooms"):
+                    homeserver.count("joined_rooms")
+                    self.reply(200, {"joined_rooms": sorted(homeserver.joined)})
+                elif path.endswith("/messages"):
+                    homeserver.count("messages")
+                    self.reply(200, {"chunk": [], "start": "t0", "end": "t0"})
+                elif "/media/" in path and "/download/" in path:
+                    homeserver.count("download")
+                    data = homeserver.media.get(path.split("/download/", 1)[1])
+                    if data is None:
+                        self.reply(404, {"errcode": "M_NOT_FOUND"})
+                    else:
+                        self.reply(200, data, "audio/ogg")
+                else:
+                    self.reply(404, {"errcode": "M_UNRECOGNIZED"})
+
+            def do_POST(self):
+                path = unquote(urlparse(self.path).path)
+                body = self.read_json()
+                if path.endswith("/login"):
+                    homeserver.count("login")
+                    self.reply(200, {"user_id": BOT_USER_ID, "access_token": "token",
+                                     "home_server": "bench.local", "device_id": "BENCH"})
+                elif "/filter" in path:
+                    homeserver.count("filter")
+                    self.reply(200, {"filter_id": "1"})
+                elif "/join/" in path or path.endswith("/join"):
+                    homeserver.count("join")
+                    room_id = path.split("/join/", 1)[1] if "/join/" in path else path.split("/rooms/", 1)[1][:-5]
+                    with homeserver.lock:
+                        homeserver.joined.add(room_id)
+                    self.reply(200, {"room_id": room_id})
+                elif path.endswith("/logout"):
+                    self.reply(200, {})
+                else:
+                    self.reply(404, {"errcode": "M_UNRECOGNIZED", "body": body})
+
+            def do_PUT(self):
+                path = unquote(urlparse(self.path).path)
+                body = self.read_json()
+                if "/send/" in path:
+                    room_id = path.split("/rooms/", 1)[1].split("/send/", 1)[0]
+                    retry_after_ms = homeserver.rate_limited.get(room_id)
+                    if retry_after_ms is not None:
+                        homeserver.count("send_429")
+                        self.reply(429, {"errcode": "M_LIMIT_EXCEEDED", "error": "Too Many Requests",
+                                         "retry_after_ms": retry_after_ms})
+                        return
+                    homeserver.count("send")
+                    self.reply(200, {"event_id": homeserver.record_send(room_id, body)})
+                else:
+                    self.reply(404, {"errcode": "M_UNRECOGNIZED"})
+
+        return Handler
+
+
+# Ersatz-Messages-API mit einstellbarer Latenz, streamend (SSE) oder am Stück
+class FakeClaude:
+    def __init__(self, first_token_latency, token_latency, tokens):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1/messages"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length))
+                with api.lock:
+                    api.requests += 1
+                words = [f"Wort{i} " for i in range(api.tokens)]
+                time.sleep(api.first_token_latency)
+
+                if not request.get("stream"):
+                    time.sleep(api.token_latency * (api.tokens - 1))
+                    data = json.dumps({"content": [{"type": "text", "text": "".join(words)}]}).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for index, word in enumerate(words):
+                    if index:
+                        time.sleep(api.token_latency)
+                    event = {"type": "content_block_delta", "index": 0,
+                             "delta": {"type": "text_delta", "text": word}}
+                    self.wfile.write(f"event: content_block_delta\ndata: {json.dumps(event)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b'event: message_stop\ndata: {"type": "message_stop"}\n\n')
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+# Warten, bis alle Befehle verarbeitet und alle Nachrichten gesendet sind
+def wait_idle(timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not bot.executor.pending() and not bot.executor.active_rooms() and not bot.outbound_sender.pending():
+            return True
+        time.sleep(0.005)
+    return False
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def make_event(room_id, body, counter, msgtype="m.text", **content):
+    return {
+        "type": "m.room.message",
+        "event_id": f"$bench{counter}",
+        "room_id": room_id,
+        "sender": USER_ID,
+        "origin_server_ts": int(time.time() * 1000),
+        "content": dict(content, msgtype=msgtype, body=body),
+    }
+
+
+# Startzeit mit N beigetretenen Räumen, erst ohne, dann mit gespeichertem Sync-Token
+def bench_startup(homeserver):
+    results = {"rooms": len(homeserver.room_ids)}
+    for label in ("cold", "warm"):
+        if label == "cold" and os.path.exists(bot.SYNC_STATE_FILE):
+            os.unlink(bot.SYNC_STATE_FILE)
+        bot.rooms.clear()
+        started = time.monotonic()
+        bot.start_bot()
+        results[label] = {
+            "total_seconds": time.monotonic() - started,
+            "phases": {name: duration for name, duration in bot.startup_timer.phases},
+        }
+        bot.save_sync_token(bot.client.sync_token)
+    return results
+
+
+# Events pro Sekunde durch on_message (Text, Befehle und Sprachnachrichten in nicht transkribierten Räumen)
+def bench_on_message(homeserver, event_count):
+    room_ids = homeserver.room_ids
+    events = []
+    for i in range(event_count):
+        room_id = room_ids[i % len(room_ids)]
+        if i % 10 == 0:
+            events.append(make_event(room_id, "!help", f"m{i}"))
+        elif i % 10 == 1:
+            events.append(make_event(room_id, "sprache.ogg", f"m{i}", msgtype="m.audio", url="mxc://bench/none"))
+        else:
+            events.append(make_event(room_id, f"Nachricht {i}", f"m{i}"))
+
+    started = time.monotonic()
+    for event in events:
+        bot.on_message(bot.rooms[event["room_id"]], event)
+    dispatched = time.monotonic() - started
+    wait_idle()
+    total = time.monotonic() - started
+    return {
+        "events": event_count,
+        "listener_events_per_second": event_count / dispatched,
+        "events_per_second": event_count / total,
+        "seconds": total,
+    }
+
+
+# Geschätzter Speicher pro Raum (Raumobjekt und Nachrichtenpuffer) nach bench_on_message
+def bench_room_memory():
+    average, total = bot.room_memory_estimate()
+    return {
+        "lightweight": bot.LIGHTWEIGHT_ROOMS,
+        "in_memory": len(bot.rooms),
+        "bytes_per_room": average,
+        "total_bytes": total,
+    }
+
+
+# Ende-zu-Ende-Latenz von !ai bei gleichzeitigen Anfragen in mehreren Räumen
+def bench_ai(homeserver, fake_claude, room_count):
+    room_ids = homeserver.room_ids[:room_count]
+    sent_before = homeserver.sent_count()
+    submitted = {}
+    started = time.monotonic()
+    for i, room_id in enumerate(room_ids):
+        submitted[room_id] = time.monotonic()
+        bot.on_message(bot.rooms[room_id], make_event(room_id, f"!ai Frage Nummer {i}", f"ai{i}-{started}"))
+    wait_idle()
+    makespan = time.monotonic() - started
+
+    # Erste sichtbare Antwort und letzte Bearbeitung pro Raum
+    first, last = {}, {}
+    for sent_at, room_id, content in homeserver.sent_since(sent_before):
+        if room_id in submitted:
+            first.setdefault(room_id, sent_at)
+            last[room_id] = sent_at
+    first_latencies = [first[r] - submitted[r] for r in first]
+    latencies = [last[r] - submitted[r] for r in last]
+    return {
+        "rooms": room_count,
+        "streaming": bot.AI_STREAMING,
+        "first_text_p50_seconds": percentile(first_latencies, 0.5),
+        "p50_seconds": percentile(latencies, 0.5),
+        "p95_seconds": percentile(latencies, 0.95),
+        "max_seconds": max(latencies) if latencies else None,
+        "makespan_seconds": makespan,
+        "api_requests": fake_claude.requests,
+    }
+
+
+# Durchsatz von transcribe_audio mit OGG-Dateien aus audio_dir
+def bench_transcribe(homeserver, audio_dir, repeats):
+    if shutil.which(bot.FFMPEG_BINARY) is None:
+        return {"skipped": f"{bot.FFMPEG_BINARY} nicht gefunden"}
+    files = sorted(glob.glob(os.path.join(audio_dir, "*.ogg"))) if audio_dir else []
+    if not files:
+        return {"skipped": "keine OGG-Dateien (--audio-dir)"}
+
+    transcription = bot.load_feature("transcription")
+    transcription.register_recognizer("null", lambda recognizer, audio_data, language: f"{len(audio_data.frame_data)} Bytes PCM")
+    for path in files:
+        with open(path, "rb") as f:
+            homeserver.media[f"bench/{os.path.basename(path)}"] = f.read()
+
+    timings = []
+    total_bytes = 0
+    started = time.monotonic()
+    for repeat in range(repeats):
+        # Frischer Cache, damit jede Runde herunterlädt, dekodiert und erkennt
+        transcription.transcription_cache = transcription.TranscriptionCache(path=None)
+        for path in files:
+            mxc_url = f"mxc://bench/{os.path.basename(path)}"
+            call_started = time.monotonic()
+            text = transcription.transcribe_audio(bot.client.api.get_download_url(mxc_url), mxc_url)
+            timings.append(time.monotonic() - call_started)
+            if text.startswith("Transkription fehlgeschlagen"):
+                return {"error": text}
+            total_bytes += len(homeserver.media[f"bench/{os.path.basename(path)}"])
+    total = time.monotonic() - started
+
+    # Wiederholte Transkription aus dem Cache
+    cached_started = time.monotonic()
+    for path in files:
+        mxc_url = f"mxc://bench/{os.path.basename(path)}"
+        transcription.transcribe_audio(bot.client.api.get_download_url(mxc_url), mxc_url)
+    cached = (time.monotonic() - cached_started) / len(files)
+
+    return {
+        "files": len(files) * repeats,
+        "files_per_second": len(timings) / total,
+        "megabytes_per_second": total_bytes / total / 1e6,
+        "p50_seconds": percentile(timings, 0.5),
+        "p95_seconds": percentile(timings, 0.95),
+        "cached_seconds": cached,
+        "recognizer": bot.RECOGNIZER_BACKEND,
+    }
+
+
+# Kosten von !schedule list und vom Anlegen/Laden bei vielen geplanten Nachrichten
+def bench_schedule(homeserver, sizes, workdir):
+    results = {}
+    scheduling = bot.load_feature("scheduling")
+    saved_store, saved_scheduler = bot.config_store, scheduling.message_scheduler
+    room_id = homeserver.room_ids[0]
+    room = bot.rooms[room_id]
+    try:
+        for size in sizes:
+            path = os.path.join(workdir, f"schedule_{size}.json")
+            bot.config_store = bot.ConfigStore(path, flush_interval=3600)
+            # Scheduler ohne Thread, damit während der Messung nichts versendet wird
+            scheduling.message_scheduler = scheduling.MessageScheduler(lambda message_id, due: None)
+
+            started = time.monotonic()
+            for i in range(size):
+                target = room_id if i % 1000 == 0 else homeserver.room_ids[i % len(homeserver.room_ids)]
+                repeat = (None, "daily", "weekdays", "weekly")[i % 4]
+                scheduling.add_scheduled_message(target, f"Nachricht {i}", f"{i % 24:02d}:{i % 60:02d}", repeat)
+            add_seconds = time.monotonic() - started
+
+            list_timings = []
+            for _ in range(20):
+                call_started = time.monotonic()
+                bot.process_command(room, USER_ID, "!schedule", "list")
+                list_timings.append(time.monotonic() - call_started)
+            wait_idle()
+
+            flush_started = time.monotonic()
+            bot.config_store.flush()
+            flush_seconds = time.monotonic() - flush_started
+
+            load_started = time.monotonic()
+            bot.config_store = bot.ConfigStore(path, flush_interval=3600)
+            scheduling.message_scheduler = scheduling.MessageScheduler(lambda message_id, due: None)
+            scheduling.load_all_scheduled_messages()
+            load_seconds = time.monotonic() - load_started
+
+            results[str(size)] = {
+                "add_per_second": size / add_seconds,
+                "list_p50_seconds": percentile(list_timings, 0.5),
+                "list_max_seconds": max(list_timings),
+                "flush_seconds": flush_seconds,
+                "load_seconds": load_seconds,
+            }
+    finally:
+        bot.config_store, scheduling.message_scheduler = saved_store, saved_scheduler
+    return results
+
+
+# Dauer einer Rundsendung an alle Räume, vom fälligen Termin bis zum letzten Ergebnis
+def bench_broadcast(homeserver):
+    scheduling = bot.load_feature("scheduling")
+    saved_scheduler = scheduling.message_scheduler
+    scheduling.message_scheduler = scheduling.MessageScheduler(lambda message_id, due: None)
+    try:
+        sent_before = homeserver.sent_count()
+        message_id = scheduling.add_scheduled_message(
+            homeserver.room_ids[0], "Rundsendung", "12:00", "daily", targets=homeserver.room_ids)
+        message_data = bot.config_store.get_scheduled_message(message_id)
+        scheduling.send_scheduled_message(message_data, time.time())
+        run = scheduling.broadcast_results[message_id]
+        deadline = time.monotonic() + 300
+        while run.duration is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        bot.config_store.remove_scheduled_message(message_id)
+        failed = sum(1 for error in run.results.values() if error is not None)
+        return {
+            "rooms": len(run.room_ids),
+            "fanout_seconds": run.duration,
+            "rooms_per_second": len(run.room_ids) / run.duration if run.duration else None,
+            "failed": failed,
+            "sent": homeserver.sent_count() - sent_before,
+        }
+    finally:
+        scheduling.message_scheduler = saved_scheduler
+
+
+# Versand in einen Raum, der immer mit M_LIMIT_EXCEEDED antwortet: Die Token-Buckets müssen
+# gedrosselt werden und nach SEND_MAX_RETRIES Wiederholungen ist Schluss
+def bench_rate_limit(homeserver, retry_after_ms=50):
+    room_id = homeserver.room_ids[-1]
+    blocked = []
+    original_block = bot.TokenBucket.block
+    def block(bucket, seconds):
+        blocked.append(seconds)
+        original_block(bucket, seconds)
+    bot.TokenBucket.block = block
+    homeserver.rate_limited[room_id] = retry_after_ms
+    attempts_before = homeserver.request_counts.get("send_429", 0)
+    try:
+        started = time.monotonic()
+        message = bot.send_text(room_id, "Ratenbegrenzt")
+        message.done.wait(120)
+        duration = time.monotonic() - started
+    finally:
+        bot.TokenBucket.block = original_block
+        del homeserver.rate_limited[room_id]
+    attempts = homeserver.request_counts.get("send_429", 0) - attempts_before
+    if not blocked or attempts != bot.SEND_MAX_RETRIES + 1 or message.error is None:
+        raise RuntimeError(f"429 nicht begrenzt behandelt: {attempts} Versuche, {len(blocked)} Drosselungen, "
+                           f"Fehler {message.error!r}")
+    return {"attempts": attempts, "bucket_blocks": len(blocked), "seconds": duration}
+
+
+# Zahlen aus zwei Ergebnisdateien gegenüberstellen
+def flatten(data, prefix=""):
+    values = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+def compare(old_results, new_results):
+    old_values = flatten(old_results["results"])
+    new_values = flatten(new_results["results"])
+    lines = [f"Vergleich mit {old_results['meta'].get('version')} vom {old_results['meta'].get('date')}:"]
+    for name in sorted(set(old_values) | set(new_values)):
+        old, new = old_values.get(name), new_values.get(name)
+        if old is None or new is None:
+            lines.append(f"  {name}: {old} -> {new}")
+        elif old:
+            lines.append(f"  {name}: {old:.4g} -> {new:.4g} ({100 * (new - old) / old:+.1f}%)")
+        else:
+            lines.append(f"  {name}: {old:.4g} -> {new:.4g}")
+    return "\n".join(lines)
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline-Benchmarks für den Matrix-Bot")
+    parser.add_argument("--rooms", type=int, default=500, help="Beigetretene Räume auf dem Ersatz-Homeserver")
+    parser.add_argument("--events", type=int, default=20000, help="Events für den on_message-Durchsatz")
+    parser.add_argument("--ai-rooms", type=int, default=50, help="Räume mit gleichzeitigem !ai")
+    parser.add_argument("--ai-first-token", type=float, default=0.3, help="Latenz bis zum ersten Token (s)")
+    parser.add_argument("--ai-token-latency", type=float, default=0.02, help="Latenz pro weiterem Token (s)")
+    parser.add_argument("--ai-tokens", type=int, default=50, help="Tokens pro Antwort")
+    parser.add_argument("--audio-dir", help="Verzeichnis mit OGG-Beispieldateien")
+    parser.add_argument("--audio-repeats", type=int, default=3)
+    parser.add_argument("--recognizer", default="null",
+                        help="Erkennungs-Backend; 'null' misst nur Download und Dekodierung")
+    parser.add_argument("--schedule-sizes", default="10000,100000", help="Anzahlen geplanter Nachrichten")
+    parser.add_argument("--realistic-rate-limits", action="store_true",
+                        help="Versand-Ratenbegrenzung des Bots nicht aufheben")
+    parser.add_argument("--full-rooms", action="store_true",
+                        help="matrix_client-Room-Objekte statt LIGHTWEIGHT_ROOMS verwenden")
+    parser.add_argument("--output", help="Ergebnisse als JSON speichern")
+    parser.add_argument("--compare", help="Mit einer früheren Ergebnisdatei vergleichen")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="bot_bench_")
+    homeserver = FakeHomeserver(args.rooms).start()
+    fake_claude = FakeClaude(args.ai_first_token, args.ai_token_latency, args.ai_tokens).start()
+
+    # Bot auf die Ersatzdienste und ein temporäres Verzeichnis umlenken
+    bot.MATRIX_SERVER = homeserver.url
+    bot.AI_API_URL = fake_claude.url
+    bot.CONFIG_FILE = os.path.join(workdir, "bot_config.json")
+    bot.SYNC_STATE_FILE = os.path.join(workdir, "bot_sync.json")
+    bot.TRANSCRIPTION_CACHE_FILE = None
+    bot.METRICS_PORT = None
+    bot.RECOGNIZER_BACKEND = args.recognizer
+    bot.LIGHTWEIGHT_ROOMS = not args.full_rooms
+    if not args.realistic_rate_limits:
+        bot.SEND_RATE_PER_ROOM = bot.SEND_RATE_GLOBAL = 1e9
+        bot.SEND_BURST_PER_ROOM = bot.SEND_BURST_GLOBAL = 1e9
+    bot.write_json_atomic(bot.CONFIG_FILE, {"scheduled_messages": [], "joined_rooms": homeserver.room_ids})
+
+    results = {}
+    try:
+        print(f"Start mit {args.rooms} Räumen...")
+        results["startup"] = bench_startup(homeserver)
+        if not args.realistic_rate_limits:
+            bot.outbound_sender.coalesce_window = 0
+        # Alle Events messen statt volle Raum-Warteschlangen zu verwerfen
+        bot.executor.room_queue_limit = args.events
+        print(f"on_message mit {args.events} Events...")
+        results["on_message"] = bench_on_message(homeserver, args.events)
+        results["room_memory"] = bench_room_memory()
+        print(f"!ai in {args.ai_rooms} Räumen gleichzeitig...")
+        results["ai"] = bench_ai(homeserver, fake_claude, min(args.ai_rooms, args.rooms))
+        print("Transkription...")
+        results["transcribe"] = bench_transcribe(homeserver, args.audio_dir, args.audio_repeats)
+        sizes = [int(size) for size in args.schedule_sizes.split(",") if size]
+        print(f"!schedule list mit {sizes} geplanten Nachrichten...")
+        results["schedule"] = bench_schedule(homeserver, sizes, workdir)
+        print(f"Rundsendung an {args.rooms} Räume...")
+        results["broadcast"] = bench_broadcast(homeserver)
+        print("Versand bei M_LIMIT_EXCEEDED...")
+        results["rate_limit"] = bench_rate_limit(homeserver)
+    finally:
+        homeserver.stop()
+        fake_claude.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        "meta": {
+            "version": git_version(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    print(json.dumps(output, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            print(compare(json.load(f), output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,32 @@
-from matrix_client.client import MatrixClient
-import speech_recognition as sr
+from matrix_client.client import MatrixClient, CACHE
+from matrix_client.api import MatrixHttpApi
+from matrix_client.errors import MatrixRequestError, MatrixHttpLibError
 import requests
+from requests.adapters import HTTPAdapter
 import json
-import schedule
 import time
 import os
 import tempfile
-import datetime
-import pytz
 import threading
+import itertools
+import traceback
+import contextlib
+import uuid
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import importlib
+import sys
+import signal
+import tracemalloc
+import sqlite3
+import socket
+from urllib.parse import urlparse
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Die Feature-Module importieren "bot"; beim Start als Skript dasselbe Modul verwenden
+sys.modules.setdefault("bot", sys.modules[__name__])
 
 # Matrix-Anmeldedaten
 MATRIX_SERVER = ""
@@ -16,169 +34,1500 @@ USERNAME = "botport"
 PASSWORD = ""
 ROOMS_TO_JOIN = []  # Leer lassen, um in Räume nur auf Einladung beizutreten
 
+# Features (Module in features/), die diese Instanz anbietet; None = alle.
+# Ein Feature wird erst beim ersten Aufruf eines seiner Befehle importiert.
+ENABLED_FEATURES = None  # z.B. ["ai", "status"]
+FEATURE_COMMANDS = {
+    "!ai": "ai",
+    "!transcribe": "transcription",
+    "!schedule": "scheduling",
+    "!status": "status",
+    "!debug": "debug",
+}
+
 # KI-API-Konfiguration
 AI_API_URL = "https://api.anthropic.com/v1/messages"  # Claude API Endpoint
 AI_API_KEY = ""
+AI_MODEL = "claude-3-sonnet-20240229"
+AI_MAX_TOKENS = 1000
+AI_STREAMING = True  # Antwort schon während der Generierung anzeigen
+AI_STREAM_EDIT_INTERVAL = 1.5  # Mindestabstand zwischen zwei Bearbeitungen in Sekunden
+AI_CACHE_TTL = 60  # Sekunden, die eine Antwort für gleiche Anfragen wiederverwendet wird
+AI_CACHE_SIZE = 256  # Maximale Anzahl zwischengespeicherter Antworten
+AI_CONTEXT_TOKENS = 1500  # Geschätzte Tokens für die letzten Nachrichten im Prompt; ältere werden zusammengefasst
+AI_SUMMARY_MAX_TOKENS = 300  # Maximale Länge der Zusammenfassung älterer Nachrichten
+AI_FALLBACK_MODEL = "claude-3-haiku-20240307"  # Ersatzmodell bei Überlastung (429/529), None zum Abschalten
+AI_TIMEOUT = (5, 60)  # (Verbindungsaufbau, Lesen) in Sekunden; beim Streaming die Pause zwischen zwei Textstücken
+AI_DEADLINE = 90  # Nach so vielen Sekunden wird keine weitere Wiederholung gestartet
+AI_MAX_RETRIES = 2  # Wiederholungen bei Zeitüberschreitung, 429 und Serverfehlern
+AI_RETRY_BASE_DELAY = 1.0  # Wartezeit vor der ersten Wiederholung, verdoppelt sich je Versuch (mit Zufallsanteil)
+AI_RETRY_MAX_DELAY = 20  # Obergrenze der Wartezeit, auch für retry-after
+AI_BREAKER_THRESHOLD = 5  # Fehlschläge in Folge, nach denen Anfragen sofort abgelehnt werden
+AI_BREAKER_COOLDOWN = 30  # Sekunden bis zum nächsten Probeversuch
+
+# Geplante Nachrichten
+DEFAULT_TIMEZONE = None  # z.B. "Europe/Berlin"; None = lokale Zeit des Servers
+SCHEDULER_CATCHUP_WINDOW = 6 * 3600  # Verpasste Termine bis zu diesem Alter (Sekunden) nach einem Neustart nachholen
+BROADCAST_PARALLELISM = 16  # Räume, an die eine Rundsendung gleichzeitig zugestellt wird
+BROADCAST_SEND_TIMEOUT = 60  # Sekunden, die auf die Zustellung in einen Raum gewartet wird
+BROADCAST_RESULTS_KEEP = 50  # Ergebnisse der letzten Rundsendungen für !schedule results
+BROADCAST_MANAGE_POWER_LEVEL = 50  # Power-Level im Raum, ab dem Tags gesetzt und Rundsendungen abbestellt werden dürfen
+
+# Benutzer mit erweiterten Rechten (Rundsendungen an beliebige Räume, !debug), z.B. ["@admin:matrix.org"]
+ADMIN_USERS = []
+
+# Diagnose (!debug, SIGUSR1 = CPU-Profil, SIGUSR2 = Speicher-Schnappschuss)
+PROFILE_DIR = "profiles"  # Hier werden Profile für die Auswertung gespeichert
+DEBUG_PROFILE_SECONDS = 10  # Standarddauer eines CPU-Profils
+DEBUG_PROFILE_MAX_SECONDS = 120
+DEBUG_SAMPLE_INTERVAL = 0.005  # Abstand der Stichproben in Sekunden
+DEBUG_TRACEMALLOC_FRAMES = 10  # Gespeicherte Aufruftiefe pro Speicherblock
+DEBUG_REPORT_LINES = 10  # Zeilen pro Abschnitt im Bericht
+
+# Mehrere Instanzen: Räume werden per Hash der Raum-ID auf die laufenden Instanzen verteilt,
+# Konfiguration und Versand geplanter Nachrichten laufen über eine gemeinsame SQLite-Datei.
+# Jede Instanz auf demselben Rechner braucht eigene Werte für SHARD_ID, METRICS_PORT,
+# SYNC_STATE_FILE und PROFILE_DIR.
+SHARD_DB = None  # z.B. "bot_shards.sqlite3"; None = einzelne Instanz mit CONFIG_FILE
+SHARD_ID = None  # Eindeutiger Name dieser Instanz; None = Rechnername und Prozess-ID
+SHARD_HEARTBEAT_INTERVAL = 5  # Sekunden zwischen Lebenszeichen und Abgleich mit den anderen Instanzen
+SHARD_LEASE_TIMEOUT = 30  # Instanz gilt nach so vielen Sekunden ohne Lebenszeichen als ausgefallen
+
+# Audio-Transkription
+TRANSCRIBE_MAX_BYTES = 20 * 1024 * 1024  # Maximale Größe einer Audiodatei
+TRANSCRIBE_SAMPLE_RATE = 16000  # PCM-Abtastrate für die Spracherkennung
+TRANSCRIBE_LANGUAGE = "de-DE"
+AUTO_TRANSCRIBE = False  # Auf True setzen für automatische Transkription in allen Räumen
+RECOGNIZER_BACKEND = "google"  # Siehe RECOGNIZER_BACKENDS, z.B. "sphinx" oder "whisper" für Offline-Erkennung
+FFMPEG_BINARY = "ffmpeg"
+FFMPEG_TIMEOUT = 30  # Sekunden für die Dekodierung, zuzüglich FFMPEG_TIMEOUT_PER_MB pro MB Audio
+FFMPEG_TIMEOUT_PER_MB = 10
+TRANSCRIBE_LONG_AUDIO_SECONDS = 45  # Längere Aufnahmen werden in Abschnitte zerlegt
+TRANSCRIBE_CHUNK_SECONDS = 30  # Höchstlänge eines Abschnitts
+TRANSCRIBE_SILENCE_DB = -35  # Pegel, unter dem ffmpeg Stille erkennt
+TRANSCRIBE_SILENCE_SECONDS = 0.4  # Mindestdauer einer Pause als Schnittstelle
+TRANSCRIBE_WORKERS = 4  # Parallel erkannte Abschnitte
+TRANSCRIPTION_CACHE_SIZE = 1000  # Anzahl gespeicherter Transkriptionen
+TRANSCRIPTION_CACHE_FILE = None  # z.B. "transcriptions.json", um den Cache über Neustarts zu behalten
+
+# Schneller Neustart
+SYNC_STATE_FILE = "bot_sync.json"  # Letzter Sync-Token, um nach einem Neustart inkrementell weiterzumachen
+SYNC_STATE_SAVE_INTERVAL = 10  # Sekunden zwischen dem Speichern des Sync-Tokens
+STARTUP_JOIN_PARALLELISM = 8  # Gleichzeitige Beitritte beim Start
+LISTENER_RETRY_DELAY = 5  # Sekunden Pause nach einem Fehler im Listener-Thread, verdoppelt sich bei jedem weiteren
+LISTENER_RETRY_MAX_DELAY = 300  # Obergrenze der Pause, z.B. solange der Homeserver nicht erreichbar ist
+INITIAL_SYNC_ATTEMPTS = 10  # Versuche für den ersten vollständigen Sync (Pausen wie beim Listener)
+
+# Sync-Filter: nur laden, was der Bot verarbeitet (None = kein Filter)
+SYNC_TIMELINE_LIMIT = 20  # Events pro Raum und Sync
+SYNC_FILTER = {
+    "presence": {"not_types": ["*"]},
+    "account_data": {"not_types": ["*"]},
+    "room": {
+        "timeline": {"types": ["m.room.message"], "limit": SYNC_TIMELINE_LIMIT, "lazy_load_members": True},
+        "state": {"types": ["m.room.member"], "lazy_load_members": True},
+        "ephemeral": {"not_types": ["*"]},
+        "account_data": {"not_types": ["*"]},
+    },
+}
+
+# Ausgehende Nachrichten
+SEND_WORKERS = 8  # Threads, die Nachrichten an den Homeserver senden
+SEND_RATE_PER_ROOM = 1.0  # Nachrichten pro Sekunde und Raum (Dauerrate)
+SEND_BURST_PER_ROOM = 5  # Kurzzeitig erlaubte Nachrichten pro Raum
+SEND_RATE_GLOBAL = 20.0  # Nachrichten pro Sekunde insgesamt
+SEND_BURST_GLOBAL = 40
+SEND_MAX_RETRIES = 5  # Wiederholungen bei 429 oder Serverfehlern
+SEND_COALESCE_WINDOW = 1.0  # Statusmeldungen so lange zurückhalten; folgt ein Ergebnis, entfällt die Statusmeldung
+SEND_WAIT_TIMEOUT = 30  # Höchstens so lange auf die Event-ID einer Antwort warten, die bearbeitet werden soll
+
+# Metriken im Prometheus-Textformat (None = kein HTTP-Endpunkt)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None  # z.B. 9464; 9100 ist meist vom node_exporter belegt
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Erkennung doppelt zugestellter Events
+DEDUP_MAX_EVENTS = 10000  # Maximale Anzahl gemerkter Event-IDs
+DEDUP_TTL = 3600  # Sekunden, die eine Event-ID gemerkt wird
+
+# Puffer der letzten Nachrichten pro Raum (für !ai und !transcribe)
+RECENT_EVENTS_PER_ROOM = 50
+
+# Räume im Speicher
+LIGHTWEIGHT_ROOMS = True  # Nur Raum-ID und Versand pro Raum statt matrix_client-Room mit Mitgliedern, Zustand und Timeline
+ROOM_IDLE_EVICT_SECONDS = 3600  # Räume ohne Nachrichten danach aus dem Speicher nehmen; None = nie
+ROOM_EVICT_INTERVAL = 300  # Sekunden zwischen zwei Prüfungen auf inaktive Räume
+ROOM_MEMORY_SAMPLE = 100  # Räume, aus denen !status den Speicher pro Raum schätzt
+
+# HTTP-Verbindungen (KI-API und Mediendownloads)
+HTTP_POOL_CONNECTIONS = 10  # Anzahl Hosts mit eigenem Verbindungspool
+HTTP_POOL_MAXSIZE = 20  # Keep-Alive-Verbindungen pro Host
+HTTP_DEFAULT_TIMEOUT = (5, 30)  # (Verbindungsaufbau, Lesen) in Sekunden
+HTTP_TIMEOUTS = {  # Abweichende Timeouts pro Host (die KI-API nutzt AI_TIMEOUT)
+    # "media.example.org": (5, 120),
+}
+HTTP_MATRIX_TIMEOUT = (5, 60)  # Für die Matrix-API, Lesen länger als der Sync-Long-Poll
 
 # Konfigurationsdatei für geplante Nachrichten
 CONFIG_FILE = "bot_config.json"
+# Wartezeit in Sekunden, mit der Änderungen gebündelt in die Datei geschrieben werden
+CONFIG_FLUSH_INTERVAL = 2.0
+
+# Parallele Befehlsausführung
+COMMAND_WORKERS = 8  # Befehle, die insgesamt gleichzeitig laufen dürfen
+ROOM_QUEUE_LIMIT = 20  # Maximal wartende Befehle pro Raum, weitere werden verworfen
+
+# Zuletzt verarbeitete Event-IDs in Einfügereihenfolge; die ältesten werden
+# nach Anzahl (max_events) und Alter (ttl) nach und nach verdrängt.
+class EventDeduplicator:
+    def __init__(self, max_events=DEDUP_MAX_EVENTS, ttl=DEDUP_TTL):
+        self.max_events = max_events
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()
+
+    # Gibt True zurück, wenn das Event neu ist, und merkt es sich
+    def add(self, event_id):
+        now = time.monotonic()
+        with self.lock:
+            if event_id in self.seen:
+                return False
+            self.seen[event_id] = now
+            while self.seen:
+                oldest_id, seen_at = next(iter(self.seen.items()))
+                if len(self.seen) <= self.max_events and now - seen_at <= self.ttl:
+                    break
+                del self.seen[oldest_id]
+            return True
+
+    def __contains__(self, event_id):
+        with self.lock:
+            return event_id in self.seen
+
+    def __len__(self):
+        with self.lock:
+            return len(self.seen)
+
+# Dauer der einzelnen Startphasen messen
+class StartupTimer:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - phase_start))
+
+    def total(self):
+        return sum(duration for _, duration in self.phases)
+
+    def report(self):
+        lines = [f"  {name}: {duration:.2f}s" for name, duration in self.phases]
+        return "Startzeiten:\n" + "\n".join(lines) + f"\n  Gesamt: {self.total():.2f}s"
+
+# Histogramm mit festen Bucket-Grenzen
+class Histogram:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Quantil aus den Buckets schätzen (lineare Interpolation innerhalb eines Buckets)
+    def quantile(self, q):
+        if not self.count:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= target and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+# Zähler, Histogramme und abgefragte Messwerte (Gauges) des Bots
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, labels)
+
+    # Messwert, der beim Abruf über func() ermittelt wird
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def counter_value(self, name, labels=None):
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def quantile(self, name, q, labels=None):
+        with self.lock:
+            histogram = self.histograms.get(self._key(name, labels))
+            return histogram.quantile(q) if histogram else None
+
+    @staticmethod
+    def _format(name, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    # Alle Metriken im Prometheus-Textformat
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{self._format(name, labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{self._format(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self._format(name + '_bucket', labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{self._format(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{self._format(name + '_count', labels)} {histogram.count}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                lines.append(f"{name} {func()}")
+            except Exception:
+                pass
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# HTTP-Handler für /metrics
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Metrik-Endpunkt in einem Hintergrund-Thread starten
+def start_metrics_server():
+    if METRICS_PORT is None:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        # Port belegt, z.B. durch eine zweite Instanz auf demselben Rechner: ohne Metriken weiterlaufen
+        print(f"Metriken-Server auf {METRICS_HOST}:{METRICS_PORT} konnte nicht gestartet werden: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metriken unter http://{METRICS_HOST}:{server.server_port}/metrics")
+    return server
+
+# Messwerte, die beim Abruf aus dem aktuellen Zustand gelesen werden
+def register_gauges():
+    metrics.gauge("bot_rooms", lambda: config_store.joined_room_count())
+    metrics.gauge("bot_rooms_in_memory", lambda: len(rooms))
+    metrics.gauge("bot_processed_events", lambda: len(processed_events))
+    metrics.gauge("bot_command_queue_depth", lambda: executor.pending())
+    metrics.gauge("bot_command_active_rooms", lambda: executor.active_rooms())
+    metrics.gauge("bot_send_queue_depth", lambda: outbound_sender.pending())
+    metrics.gauge("bot_messages_sent", lambda: outbound_sender.sent)
+    metrics.gauge("bot_messages_coalesced", lambda: outbound_sender.dropped)
+    metrics.gauge("bot_messages_failed", lambda: outbound_sender.failed)
+    metrics.gauge("bot_scheduled_messages", lambda: config_store.scheduled_message_count())
+    if shard_coordinator is not None:
+        metrics.gauge("bot_shards_live", lambda: len(shard_coordinator.live_shards))
+
+# Trefferquote in Prozent oder "-" ohne Anfragen
+def hit_rate(hits, misses):
+    total = hits + misses
+    return f"{100 * hits / total:.0f}%" if total else "-"
+
+# Quantil einer Metrik für !status formatieren
+def format_quantile(name, q, labels=None):
+    value = metrics.quantile(name, q, labels)
+    return f"{value:.2f}s" if value is not None else "-"
 
 # Globale Variablen
 client = None
 rooms = {}
-processed_events = set()
+processed_events = EventDeduplicator()
+config_store = None
+executor = None
+http_session = None
+http_session_lock = threading.Lock()
+recent_events = {}
+recent_events_lock = threading.Lock()
+startup_timer = None
+outbound_sender = None
+shard_coordinator = None
+features = {}
+command_handlers = {}
+features_lock = threading.RLock()
+listener_failures = 0
+listener_failure_token = None
 
-# Konfiguration laden
-def load_config():
+# JSON atomar schreiben: erst in eine temporäre Datei, dann umbenennen
+def write_json_atomic(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=directory)
     try:
-        with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # Standardkonfiguration erstellen
-        default_config = {
-            "scheduled_messages": [],
-            "joined_rooms": []
-        }
-        save_config(default_config)
-        return default_config
-
-# Konfiguration speichern
-def save_config(config):
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(config, f, indent=4)
-
-# KI-Antwort mit Claude von Anthropic generieren
-def get_ai_response(message):
-    headers = {
-        "x-api-key": AI_API_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
-    
-    data = {
-        "model": "claude-3-sonnet-20240229",
-        "max_tokens": 1000,
-        "messages": [
-            {
-                "role": "user",
-                "content": message
+        with os.fdopen(fd, "w") as f:
+            f.write(data if isinstance(data, str) else json.dumps(data, indent=4))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+# Einstellungen pro Raum ({Raum-ID: {Schlüssel: Wert}}) aus der Konfiguration lesen. Ältere
+# Konfigurationen hatten dafür je ein Dict über alle Räume (room_timezones, room_tags).
+def load_room_settings(config):
+    room_settings = config.pop("room_settings", {})
+    for room_id, timezone in config.pop("room_timezones", {}).items():
+        room_settings.setdefault(room_id, {})["timezone"] = timezone
+    for tag, room_ids in config.pop("room_tags", {}).items():
+        for room_id in room_ids:
+            room_settings.setdefault(room_id, {}).setdefault("tags", []).append(tag)
+    return room_settings
+
+# Konfiguration im Speicher, indiziert nach Nachrichten-ID und Raum.
+# Änderungen werden von einem Hintergrund-Thread gebündelt und atomar gespeichert.
+class ConfigStore:
+    def __init__(self, path, flush_interval=CONFIG_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.dirty = threading.Event()
+        self.closed = False
+        self.flush_thread = None
+        self.load()
+
+    # Konfiguration einmalig von der Platte lesen und Indizes aufbauen
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                config = json.load(f)
+            created = False
+        except FileNotFoundError:
+            # Standardkonfiguration erstellen
+            config = {
+                "scheduled_messages": [],
+                "joined_rooms": []
             }
-        ]
-    }
-    
-    try:
-        response = requests.post("https://api.anthropic.com/v1/messages", headers=headers, json=data)
-        if response.status_code == 200:
-            response_json = response.json()
-            return response_json.get("content", [{}])[0].get("text", "Keine Antwort erhalten.")
-        else:
-            return f"Fehler bei der API-Anfrage: Status {response.status_code}, {response.text}"
-    except Exception as e:
-        return f"Fehler bei der KI-Anfrage: {str(e)}"
+            created = True
 
-# Audio-Transkription
-# Audio-Transkription mit pydub
-def transcribe_audio(audio_url):
-    # Audio von URL herunterladen
-    with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_file:
-        response = requests.get(audio_url)
-        temp_file.write(response.content)
-        temp_file_path = temp_file.name
-    
-    try:
-        # Konvertiere Audio zu WAV Format mit pydub
-        from pydub import AudioSegment
-        
-        # Installiere zuerst pydub: pip install pydub
-        sound = AudioSegment.from_file(temp_file_path, format="ogg")
-        
-        wav_temp_file = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-        wav_temp_path = wav_temp_file.name
-        wav_temp_file.close()
-        
-        sound.export(wav_temp_path, format="wav")
+        with self.lock:
+            self.messages_by_id = {}
+            self.messages_by_room = {}
+            for message_data in config.pop("scheduled_messages", []):
+                self._index_message(message_data)
+            self.joined_rooms = dict.fromkeys(config.pop("joined_rooms", []))
+            self.auto_transcribe_rooms = set(config.get("auto_transcribe_rooms", []))
+            self.room_settings = load_room_settings(config)
+            # Unbekannte Schlüssel unverändert mitführen
+            self.extra = config
+            self.next_id = max(self.messages_by_id, default=-1) + 1
+
+        if created:
+            self.mark_dirty()
+
+    def _index_message(self, message_data):
+        self.messages_by_id[message_data["id"]] = message_data
+        self.messages_by_room.setdefault(message_data["room_id"], {})[message_data["id"]] = message_data
+
+    def _unindex_message(self, message_data):
+        self.messages_by_id.pop(message_data["id"], None)
+        room_messages = self.messages_by_room.get(message_data["room_id"])
+        if room_messages is not None:
+            room_messages.pop(message_data["id"], None)
+            if not room_messages:
+                del self.messages_by_room[message_data["room_id"]]
+
+    # Geplante Nachrichten
+    def scheduled_messages(self):
+        with self.lock:
+            return list(self.messages_by_id.values())
+
+    def scheduled_message_count(self):
+        with self.lock:
+            return len(self.messages_by_id)
+
+    def get_scheduled_message(self, message_id):
+        with self.lock:
+            return self.messages_by_id.get(message_id)
+
+    def room_scheduled_messages(self, room_id):
+        with self.lock:
+            return list(self.messages_by_room.get(room_id, {}).values())
+
+    def add_scheduled_message(self, message_data):
+        with self.lock:
+            message_data["id"] = self.next_id
+            self.next_id += 1
+            self._index_message(message_data)
+        self.mark_dirty()
+        return message_data["id"]
+
+    def update_scheduled_message(self, message_id, **changes):
+        with self.lock:
+            message_data = self.messages_by_id.get(message_id)
+            if message_data is None:
+                return None
+            message_data.update(changes)
+        self.mark_dirty()
+        return message_data
+
+    def remove_scheduled_message(self, message_id):
+        with self.lock:
+            message_data = self.messages_by_id.get(message_id)
+            if message_data is None:
+                return None
+            self._unindex_message(message_data)
+        self.mark_dirty()
+        return message_data
+
+    # Räume
+    def joined_room_ids(self):
+        with self.lock:
+            return list(self.joined_rooms)
+
+    def add_joined_room(self, room_id):
+        with self.lock:
+            if room_id in self.joined_rooms:
+                return False
+            self.joined_rooms[room_id] = None
+        self.mark_dirty()
+        return True
+
+    def is_joined_room(self, room_id):
+        with self.lock:
+            return room_id in self.joined_rooms
+
+    def joined_room_count(self):
+        with self.lock:
+            return len(self.joined_rooms)
+
+    def is_auto_transcribe_room(self, room_id):
+        return room_id in self.auto_transcribe_rooms
+
+    # Einstellungen eines Raums, einzeln gespeichert, damit Änderungen in verschiedenen
+    # Räumen sich nicht gegenseitig überschreiben. value=None entfernt die Einstellung.
+    def get_room_setting(self, room_id, key, default=None):
+        with self.lock:
+            return self.room_settings.get(room_id, {}).get(key, default)
+
+    def set_room_setting(self, room_id, key, value):
+        with self.lock:
+            self._apply_room_setting(room_id, key, value)
+        self.mark_dirty()
+
+    def _apply_room_setting(self, room_id, key, value):
+        if value is not None:
+            self.room_settings.setdefault(room_id, {})[key] = value
+        elif key in self.room_settings.get(room_id, {}):
+            del self.room_settings[room_id][key]
+            if not self.room_settings[room_id]:
+                del self.room_settings[room_id]
+
+    # Raum-ID -> Wert für alle Räume mit dieser Einstellung
+    def room_setting_values(self, key):
+        with self.lock:
+            return {room_id: settings[key] for room_id, settings in self.room_settings.items() if key in settings}
+
+    # Sonstige Konfigurationswerte
+    def get(self, key, default=None):
+        with self.lock:
+            return self.extra.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.extra[key] = value
+            if key == "auto_transcribe_rooms":
+                self.auto_transcribe_rooms = set(value)
+        self.mark_dirty()
+
+    # Persistenz
+    def snapshot(self):
+        with self.lock:
+            config = dict(self.extra)
+            config["scheduled_messages"] = list(self.messages_by_id.values())
+            config["joined_rooms"] = list(self.joined_rooms)
+            config["room_settings"] = self.room_settings
+            # Unter der Sperre serialisieren, damit parallele Änderungen nicht stören
+            return json.dumps(config, indent=4)
+
+    def mark_dirty(self):
+        self.dirty.set()
+
+    def flush(self):
+        self.dirty.clear()
+        write_json_atomic(self.path, self.snapshot())
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.dirty.wait()
+            # Weitere Änderungen abwarten und gemeinsam schreiben
+            time.sleep(self.flush_interval)
+            if self.closed:
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Fehler beim Speichern der Konfiguration: {str(e)}")
+                self.mark_dirty()
+
+    def start(self):
+        self.flush_thread = threading.Thread(target=self._flush_loop, name="config", daemon=True)
+        self.flush_thread.start()
+
+    def close(self):
+        self.closed = True
+        if self.dirty.is_set():
+            self.flush()
+
+# Gemeinsame SQLite-Datei aller Instanzen; Änderungen laufen in kurzen Transaktionen
+class SharedStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS scheduled_messages (
+            id INTEGER PRIMARY KEY, room_id TEXT NOT NULL, data TEXT, revision INTEGER NOT NULL, origin TEXT);
+        CREATE INDEX IF NOT EXISTS scheduled_messages_revision ON scheduled_messages (revision);
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY, value TEXT NOT NULL, revision INTEGER NOT NULL, origin TEXT);
+        CREATE TABLE IF NOT EXISTS room_settings (
+            room_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, revision INTEGER NOT NULL, origin TEXT,
+            PRIMARY KEY (room_id, key));
+        CREATE TABLE IF NOT EXISTS joined_rooms (
+            room_id TEXT PRIMARY KEY, revision INTEGER NOT NULL, origin TEXT);
+        CREATE TABLE IF NOT EXISTS shards (shard_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS deliveries (
+            message_id INTEGER NOT NULL, due REAL NOT NULL, shard_id TEXT NOT NULL,
+            claimed_at REAL NOT NULL, sent_at REAL, PRIMARY KEY (message_id, due));
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            message_id INTEGER NOT NULL, due REAL NOT NULL, room_id TEXT NOT NULL,
+            sent_at REAL NOT NULL, PRIMARY KEY (message_id, due, room_id));
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            # Schreibsperre sofort holen, damit parallele Instanzen nacheinander schreiben
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # Fortlaufende Revisionsnummer für Änderungen (innerhalb einer Transaktion aufrufen)
+    def next_revision(self, conn):
+        conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('revision', 0)")
+        conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'revision'")
+        return conn.execute("SELECT value FROM counters WHERE name = 'revision'").fetchone()[0]
+
+    def revision(self):
+        rows = self.query("SELECT value FROM counters WHERE name = 'revision'")
+        return rows[0][0] if rows else None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Konfiguration in der gemeinsamen SQLite-Datei. Gelesen wird wie bei ConfigStore aus dem
+# Speicher, Änderungen werden sofort geschrieben und von poll() bei den anderen Instanzen übernommen.
+class SqliteConfigStore(ConfigStore):
+    def __init__(self, store, shard_id, import_path=None):
+        self.store = store
+        self.shard_id = shard_id
+        self.revision = 0
+        super().__init__(import_path)
+
+    def load(self):
+        with self.lock:
+            self.messages_by_id = {}
+            self.messages_by_room = {}
+            self.joined_rooms = {}
+            self.auto_transcribe_rooms = set()
+            self.room_settings = {}
+            self.extra = {}
+            self.revision = 0
+        if self.path and self.store.revision() is None:
+            self.import_file(self.path)
+        self.poll(include_own=True)
+
+    # Vorhandene Konfigurationsdatei beim ersten Start übernehmen, IDs bleiben erhalten
+    def import_file(self, path):
+        try:
+            with open(path, "r") as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        with self.store.transaction() as conn:
+            # Eine andere Instanz war schneller
+            if conn.execute("SELECT 1 FROM counters WHERE name = 'revision'").fetchone():
+                return
+            revision = self.store.next_revision(conn)
+            for message_data in config.pop("scheduled_messages", []):
+                conn.execute(
+                    "INSERT INTO scheduled_messages (id, room_id, data, revision, origin) VALUES (?, ?, ?, ?, ?)",
+                    (message_data["id"], message_data["room_id"], json.dumps(message_data), revision, self.shard_id))
+            for room_id in config.pop("joined_rooms", []):
+                conn.execute("INSERT OR IGNORE INTO joined_rooms (room_id, revision, origin) VALUES (?, ?, ?)",
+                             (room_id, revision, self.shard_id))
+            for room_id, settings in load_room_settings(config).items():
+                for key, value in settings.items():
+                    conn.execute(
+                        "INSERT INTO room_settings (room_id, key, value, revision, origin) VALUES (?, ?, ?, ?, ?)",
+                        (room_id, key, json.dumps(value), revision, self.shard_id))
+            for key, value in config.items():
+                conn.execute("INSERT INTO settings (key, value, revision, origin) VALUES (?, ?, ?, ?)",
+                             (key, json.dumps(value), revision, self.shard_id))
+        print(f"Konfiguration aus {path} in {self.store.path} übernommen")
+
+    # Änderungen seit dem letzten Aufruf übernehmen. Liefert geänderte Nachrichten,
+    # entfernte Nachrichten-IDs, neue Räume und die Schlüssel geänderter Einstellungen
+    # (auch von Raum-Einstellungen, z.B. "timezone").
+    def poll(self, include_own=False):
+        current = self.store.revision() or 0
+        # Eigene Änderungen sind schon im Speicher
+        params = (self.revision, current, "" if include_own else self.shard_id)
+        message_rows = self.store.query(
+            "SELECT id, data FROM scheduled_messages WHERE revision > ? AND revision <= ? AND origin != ?", params)
+        room_rows = self.store.query(
+            "SELECT room_id FROM joined_rooms WHERE revision > ? AND revision <= ? AND origin != ?", params)
+        setting_rows = self.store.query(
+            "SELECT key, value FROM settings WHERE revision > ? AND revision <= ? AND origin != ?", params)
+        room_setting_rows = self.store.query(
+            "SELECT room_id, key, value FROM room_settings WHERE revision > ? AND revision <= ? AND origin != ?", params)
+
+        changed, removed = [], []
+        with self.lock:
+            for message_id, data in message_rows:
+                old = self.messages_by_id.get(message_id)
+                if old is not None:
+                    self._unindex_message(old)
+                if data is None:
+                    removed.append(message_id)
+                else:
+                    message_data = json.loads(data)
+                    self._index_message(message_data)
+                    changed.append(message_data)
+            for (room_id,) in room_rows:
+                self.joined_rooms[room_id] = None
+            for key, value in setting_rows:
+                self.extra[key] = json.loads(value)
+                if key == "auto_transcribe_rooms":
+                    self.auto_transcribe_rooms = set(self.extra[key])
+            for room_id, key, value in room_setting_rows:
+                self._apply_room_setting(room_id, key, None if value is None else json.loads(value))
+            self.revision = max(self.revision, current)
+        settings = [row[0] for row in setting_rows] + list(dict.fromkeys(row[1] for row in room_setting_rows))
+        return changed, removed, [row[0] for row in room_rows], settings
+
+    # Nachricht schreiben; entfernte Nachrichten bleiben ohne Daten stehen, damit
+    # die anderen Instanzen das Entfernen sehen und die ID nicht erneut vergeben wird
+    def _write_message(self, message_data, removed=False):
+        with self.store.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO scheduled_messages (id, room_id, data, revision, origin) VALUES (?, ?, ?, ?, ?)",
+                (message_data["id"], message_data["room_id"], None if removed else json.dumps(message_data),
+                 self.store.next_revision(conn), self.shard_id))
+
+    def add_scheduled_message(self, message_data):
+        with self.lock:
+            with self.store.transaction() as conn:
+                # IDs über alle Instanzen hinweg eindeutig vergeben
+                message_data["id"] = conn.execute(
+                    "SELECT COALESCE(MAX(id), -1) + 1 FROM scheduled_messages").fetchone()[0]
+                conn.execute(
+                    "INSERT INTO scheduled_messages (id, room_id, data, revision, origin) VALUES (?, ?, ?, ?, ?)",
+                    (message_data["id"], message_data["room_id"], json.dumps(message_data),
+                     self.store.next_revision(conn), self.shard_id))
+            self._index_message(message_data)
+        return message_data["id"]
+
+    # Änderungen auf den aktuellen Stand in der Datenbank anwenden: Felder, die eine andere
+    # Instanz geändert hat, bleiben erhalten, und eine dort entfernte Nachricht wird nicht
+    # wiederhergestellt
+    def update_scheduled_message(self, message_id, **changes):
+        with self.lock:
+            with self.store.transaction() as conn:
+                row = conn.execute("SELECT data FROM scheduled_messages WHERE id = ?", (message_id,)).fetchone()
+                if row is None or row[0] is None:
+                    stored = None
+                else:
+                    stored = dict(json.loads(row[0]), **changes)
+                    conn.execute("UPDATE scheduled_messages SET data = ?, revision = ?, origin = ? WHERE id = ?",
+                                 (json.dumps(stored), self.store.next_revision(conn), self.shard_id, message_id))
+            if stored is None:
+                # poll() meldet das Entfernen später dem Scheduler
+                message_data = self.messages_by_id.get(message_id)
+                if message_data is not None:
+                    self._unindex_message(message_data)
+                return None
+            return super().update_scheduled_message(message_id, **stored)
+
+    def remove_scheduled_message(self, message_id):
+        with self.lock:
+            message_data = super().remove_scheduled_message(message_id)
+            if message_data is not None:
+                self._write_message(message_data, removed=True)
+        return message_data
+
+    def add_joined_room(self, room_id):
+        with self.lock:
+            if not super().add_joined_room(room_id):
+                return False
+            with self.store.transaction() as conn:
+                conn.execute("INSERT OR REPLACE INTO joined_rooms (room_id, revision, origin) VALUES (?, ?, ?)",
+                             (room_id, self.store.next_revision(conn), self.shard_id))
+        return True
+
+    def set_room_setting(self, room_id, key, value):
+        with self.lock:
+            super().set_room_setting(room_id, key, value)
+            with self.store.transaction() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO room_settings (room_id, key, value, revision, origin) VALUES (?, ?, ?, ?, ?)",
+                    (room_id, key, None if value is None else json.dumps(value),
+                     self.store.next_revision(conn), self.shard_id))
+
+    def set(self, key, value):
+        with self.lock:
+            super().set(key, value)
+            with self.store.transaction() as conn:
+                conn.execute("INSERT OR REPLACE INTO settings (key, value, revision, origin) VALUES (?, ?, ?, ?)",
+                             (key, json.dumps(value), self.store.next_revision(conn), self.shard_id))
+
+    # Alles ist bereits geschrieben, kein Schreib-Thread nötig
+    def mark_dirty(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def start(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+# Verteilung der Räume auf die laufenden Instanzen. Jede Instanz meldet sich regelmäßig in
+# der Tabelle shards; ein Raum gehört der lebenden Instanz mit dem höchsten Hash aus Instanz
+# und Raum-ID. Fällt eine Instanz aus, wandern nur ihre Räume, verteilt auf die übrigen.
+class ShardCoordinator:
+    def __init__(self, store, shard_id, on_sync=None):
+        self.store = store
+        self.shard_id = shard_id
+        self.on_sync = on_sync
+        self.live_shards = (shard_id,)
+        self.closed = threading.Event()
+        self.heartbeat()
+
+    def heartbeat(self):
+        now = time.time()
+        with self.store.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO shards (shard_id, heartbeat) VALUES (?, ?)", (self.shard_id, now))
+            # Versandeinträge werden nur innerhalb des Nachholfensters gebraucht
+            conn.execute("DELETE FROM deliveries WHERE due < ?", (now - 2 * SCHEDULER_CATCHUP_WINDOW,))
+            conn.execute("DELETE FROM broadcast_deliveries WHERE due < ?", (now - 2 * SCHEDULER_CATCHUP_WINDOW,))
+        rows = self.store.query("SELECT shard_id FROM shards WHERE heartbeat >= ?", (now - SHARD_LEASE_TIMEOUT,))
+        live = tuple(sorted({row[0] for row in rows} | {self.shard_id}))
+        if live != self.live_shards:
+            print(f"Aktive Instanzen: {', '.join(live)}")
+            self.live_shards = live
+
+    def owner(self, room_id):
+        return max(self.live_shards, key=lambda shard_id: hashlib.sha256(f"{shard_id}\n{room_id}".encode()).digest())
+
+    def owns_room(self, room_id):
+        return self.owner(room_id) == self.shard_id
+
+    # Termin einer geplanten Nachricht beanspruchen. Gelingt nur, wenn er noch nicht versendet
+    # wurde und kein Anspruch einer anderen, noch lebenden Instanz besteht.
+    def claim_delivery(self, message_id, due):
+        now = time.time()
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT shard_id, sent_at FROM deliveries WHERE message_id = ? AND due = ?",
+                               (message_id, due)).fetchone()
+            if row is not None:
+                claimed_by, sent_at = row
+                if sent_at is not None:
+                    return False
+                if claimed_by != self.shard_id:
+                    heartbeat = conn.execute("SELECT heartbeat FROM shards WHERE shard_id = ?", (claimed_by,)).fetchone()
+                    if heartbeat is not None and heartbeat[0] >= now - SHARD_LEASE_TIMEOUT:
+                        return False
+                    print(f"Geplante Nachricht {message_id} von ausgefallener Instanz {claimed_by} übernommen")
+            conn.execute(
+                "INSERT OR REPLACE INTO deliveries (message_id, due, shard_id, claimed_at, sent_at) VALUES (?, ?, ?, ?, NULL)",
+                (message_id, due, self.shard_id, now))
+        return True
+
+    def finish_delivery(self, message_id, due):
+        with self.store.transaction() as conn:
+            conn.execute("UPDATE deliveries SET sent_at = ? WHERE message_id = ? AND due = ? AND shard_id = ?",
+                         (time.time(), message_id, due, self.shard_id))
+
+    def release_delivery(self, message_id, due):
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM deliveries WHERE message_id = ? AND due = ? AND shard_id = ? AND sent_at IS NULL",
+                         (message_id, due, self.shard_id))
+
+    # Räume, in die ein Termin einer Rundsendung schon zugestellt wurde; übernimmt eine
+    # Instanz eine unterbrochene Rundsendung, werden diese Räume übersprungen
+    def broadcast_sent_rooms(self, message_id, due):
+        rows = self.store.query("SELECT room_id FROM broadcast_deliveries WHERE message_id = ? AND due = ?",
+                                (message_id, due))
+        return {row[0] for row in rows}
+
+    def mark_broadcast_room(self, message_id, due, room_id):
+        with self.store.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO broadcast_deliveries (message_id, due, room_id, sent_at) VALUES (?, ?, ?, ?)",
+                         (message_id, due, room_id, time.time()))
+
+    def run(self):
+        while not self.closed.wait(SHARD_HEARTBEAT_INTERVAL):
+            try:
+                self.heartbeat()
+                if self.on_sync:
+                    self.on_sync()
+            except Exception as e:
+                print(f"Fehler beim Abgleich mit den anderen Instanzen: {str(e)}")
+
+    def start(self):
+        threading.Thread(target=self.run, name="shard", daemon=True).start()
+
+    # Abmelden, damit die übrigen Instanzen die Räume sofort übernehmen
+    def close(self):
+        self.closed.set()
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM shards WHERE shard_id = ?", (self.shard_id,))
+        self.store.close()
+
+# Befehle pro Raum der Reihe nach, raumübergreifend parallel ausführen.
+# Solange ein Raum einen Eintrag in lanes hat, läuft dort gerade eine Aufgabe;
+# weitere Aufgaben des Raums warten in dessen Warteschlange.
+class CommandExecutor:
+    def __init__(self, max_workers=COMMAND_WORKERS, room_queue_limit=ROOM_QUEUE_LIMIT):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="command")
+        self.room_queue_limit = room_queue_limit
+        self.lock = threading.Lock()
+        self.lanes = {}
+
+    def submit(self, room_id, func, *args):
+        with self.lock:
+            lane = self.lanes.get(room_id)
+            if lane is not None:
+                if len(lane) >= self.room_queue_limit:
+                    return False
+                lane.append((func, args))
+                return True
+            self.lanes[room_id] = deque()
+        self.pool.submit(self._run, room_id, func, args)
+        return True
+
+    def _run(self, room_id, func, args):
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+        with self.lock:
+            lane = self.lanes[room_id]
+            if not lane:
+                del self.lanes[room_id]
+                return
+            func, args = lane.popleft()
+        # Nächste Aufgabe hinten anstellen, damit andere Räume nicht warten müssen
+        self.pool.submit(self._run, room_id, func, args)
+
+    def pending(self):
+        with self.lock:
+            return sum(len(lane) for lane in self.lanes.values())
+
+    def active_rooms(self):
+        with self.lock:
+            return len(self.lanes)
+
+    def busy(self, room_id):
+        with self.lock:
+            return room_id in self.lanes
+
+    def shutdown(self, wait=False):
+        self.pool.shutdown(wait=wait)
+
+# Token-Bucket: rate Tokens pro Sekunde, höchstens burst auf Vorrat
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Blockiert, bis ein Token frei ist
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Nach einem 429 für die angegebene Zeit keine Tokens ausgeben
+    def block(self, seconds):
+        with self.lock:
+            self.tokens = min(self.tokens, 1) - seconds * self.rate
+
+# Eine ausgehende Nachricht; wait() liefert die Event-ID, sobald sie gesendet ist
+class OutboundMessage:
+    def __init__(self, room_id, content, status=False, replaces=None):
+        self.room_id = room_id
+        self.content = content
+        self.status = status
+        self.replaces = replaces
+        # Gleiche Transaktions-ID bei Wiederholungen, damit der Homeserver keine Duplikate anlegt
+        self.txn_id = uuid.uuid4().hex
+        self.created = time.monotonic()
+        self.done = threading.Event()
+        self.event_id = None
+        self.error = None
+        self.sending = False  # Zustellung läuft, cancel() greift nicht mehr
+        self.cancelled = False
+
+    def finish(self, event_id=None, error=None):
+        self.event_id = event_id
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.event_id
+
+# Versand aller Nachrichten: pro Raum in Reihenfolge, mit Token-Buckets pro Raum und global,
+# Wiederholung nach retry_after_ms und Zusammenfassen von Status- und Ergebnismeldungen
+class OutboundSender:
+    def __init__(self, workers=SEND_WORKERS, coalesce_window=SEND_COALESCE_WINDOW, api=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="send")
+        self.api = api  # None = client.api
+        self.coalesce_window = coalesce_window
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.held = {}  # Raum-ID -> Timer einer zurückgehaltenen Statusmeldung
+        self.room_buckets = {}
+        self.global_bucket = TokenBucket(SEND_RATE_GLOBAL, SEND_BURST_GLOBAL)
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def send(self, room_id, content, status=False, replaces=None):
+        message = OutboundMessage(room_id, content, status, replaces)
+        with self.cond:
+            queue = self.queues.get(room_id)
+            start = queue is None
+            if start:
+                queue = self.queues[room_id] = deque()
+            queue.append(message)
+            # Eine zurückgehaltene Statusmeldung ist jetzt überflüssig: sofort weitermachen
+            timer = self.held.pop(room_id, None)
+        if timer is not None:
+            timer.cancel()
+        if start or timer is not None:
+            self.pool.submit(self._send_next, room_id)
+        return message
+
+    # Noch nicht begonnene Nachricht verwerfen; wait() liefert dann None. False, wenn die
+    # Zustellung schon läuft oder abgeschlossen ist.
+    def cancel(self, message):
+        with self.cond:
+            if message.sending or message.done.is_set():
+                return False
+            message.cancelled = True
+        message.finish()
+        return True
+
+    # Zähler für Status und Metriken; mehrere Versand-Threads zählen gleichzeitig
+    def _count(self, name):
+        with self.cond:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def pending(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    # Token-Bucket eines Raums ohne wartende Nachrichten verwerfen, sofern er wieder voll ist
+    def forget_room(self, room_id):
+        with self.cond:
+            bucket = self.room_buckets.get(room_id)
+            if room_id in self.queues or bucket is None:
+                return
+            if bucket.tokens + (time.monotonic() - bucket.updated) * bucket.rate >= bucket.burst:
+                del self.room_buckets[room_id]
+
+    def _room_bucket(self, room_id):
+        with self.cond:
+            bucket = self.room_buckets.get(room_id)
+            if bucket is None:
+                bucket = self.room_buckets[room_id] = TokenBucket(SEND_RATE_PER_ROOM, SEND_BURST_PER_ROOM)
+            return bucket
+
+    # Prüfen, ob die erste Nachricht der Warteschlange durch eine spätere überflüssig ist
+    def _superseded(self, queue):
+        message = queue[0]
+        if message.status:
+            return len(queue) > 1
+        if message.replaces:
+            return any(later.replaces == message.replaces for later in itertools.islice(queue, 1, None))
+        return False
+
+    # Nach Ablauf des Zeitfensters die zurückgehaltene Statusmeldung senden, sofern
+    # send() den Raum nicht schon wieder angestoßen hat
+    def _release(self, room_id, timer):
+        with self.cond:
+            if self.held.get(room_id) is not timer:
+                return
+            del self.held[room_id]
+        self.pool.submit(self._send_next, room_id)
+
+    def _send_next(self, room_id):
+        with self.cond:
+            queue = self.queues[room_id]
+            message = queue[0]
+            remaining = message.created + self.coalesce_window - time.monotonic()
+            if message.status and len(queue) == 1 and remaining > 0:
+                # Statusmeldung mit einem Timer zurückhalten, statt einen Versand-Thread zu blockieren
+                timer = threading.Timer(remaining, lambda: self._release(room_id, timer))
+                timer.daemon = True
+                self.held[room_id] = timer
+                timer.start()
+                return
+            superseded = not message.cancelled and self._superseded(queue)
+            message.sending = not (message.cancelled or superseded)
         
-        # Audio in Text umwandeln
-        recognizer = sr.Recognizer()
-        with sr.AudioFile(wav_temp_path) as source:
-            audio_data = recognizer.record(source)
-            text = recognizer.recognize_google(audio_data, language="de-DE")
-            return text
-    except Exception as e:
-        return f"Transkription fehlgeschlagen: {str(e)}"
-    finally:
-        # Temporäre Dateien aufräumen
-        os.unlink(temp_file_path)
-        if 'wav_temp_path' in locals():
+        try:
+            if superseded:
+                message.finish()
+                self._count("dropped")
+            elif message.sending:
+                self._deliver(message)
+        except Exception as e:
+            # Unerwartete Fehler dürfen die Warteschlange des Raums nicht anhalten
+            self._count("failed")
+            print(f"Fehler beim Senden an Raum {room_id}: {str(e)}")
+            message.finish(error=e)
+        finally:
+            with self.cond:
+                queue.popleft()
+                more = bool(queue)
+                if not more:
+                    del self.queues[room_id]
+            # Nächste Nachricht des Raums hinten anstellen, damit andere Räume nicht warten
+            if more:
+                self.pool.submit(self._send_next, room_id)
+
+    def _deliver(self, message):
+        room_bucket = self._room_bucket(message.room_id)
+        error = None
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            room_bucket.acquire()
+            self.global_bucket.acquire()
             try:
-                os.unlink(wav_temp_path)
-            except:
-                pass
+                response = (self.api or client.api).send_message_event(
+                    message.room_id, "m.room.message", message.content, txn_id=message.txn_id)
+                message.finish(response.get("event_id"))
+                self._count("sent")
+                return
+            except MatrixRequestError as e:
+                error = e
+                if e.code == 429:
+                    # Synapse begrenzt pro Benutzer: Raum- und globaler Bucket halten den
+                    # nächsten Versuch bis retry_after_ms zurück
+                    wait = retry_after_seconds(e, 2 ** attempt)
+                    room_bucket.block(wait)
+                    self.global_bucket.block(wait)
+                    continue
+                elif e.code >= 500:
+                    delay = 2 ** attempt
+                else:
+                    break
+            except MatrixHttpLibError as e:
+                error = e
+                delay = 2 ** attempt
+            time.sleep(delay)
+        
+        self._count("failed")
+        print(f"Nachricht an Raum {message.room_id} konnte nicht gesendet werden: {str(error)}")
+        message.finish(error=error)
+
+    # Auf noch nicht gesendete Nachrichten warten (beim Beenden)
+    def flush(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(0.1)
 
-# Geplante Nachricht hinzufügen
-def add_scheduled_message(room_id, message, schedule_time, repeat=None):
-    config = load_config()
-    message_id = len(config["scheduled_messages"])
-    new_message = {
-        "id": message_id,
-        "room_id": room_id,
-        "message": message,
-        "schedule_time": schedule_time,
-        "repeat": repeat
+# Matrix-API für den OutboundSender. MatrixHttpApi._send wartet bei 429 selbst und wiederholt
+# ohne Grenze; hier wird 429 als MatrixRequestError gemeldet, damit _deliver die Token-Buckets
+# drosselt und SEND_MAX_RETRIES gilt. Eigene Session, weil der Hook für alle ihre Anfragen gilt.
+class SendMatrixHttpApi(MatrixHttpApi):
+    def __init__(self, api):
+        super().__init__(api._base_url, token=api.token, use_authorization_header=api.use_authorization_header)
+        self.validate_cert = api.validate_cert
+        mount_pooled_adapter(self.session, timeout=HTTP_MATRIX_TIMEOUT)
+        self.session.hooks["response"].append(raise_on_rate_limit)
+
+# Response-Hook: 429 sofort als Fehler melden (wird von MatrixHttpApi._send nicht abgefangen)
+def raise_on_rate_limit(response, *args, **kwargs):
+    if response.status_code == 429:
+        raise MatrixRequestError(code=429, content=response.text)
+
+# Wartezeit aus einer M_LIMIT_EXCEEDED-Antwort lesen
+def retry_after_seconds(error, default):
+    try:
+        return json.loads(error.content)["retry_after_ms"] / 1000
+    except (ValueError, KeyError, TypeError):
+        return default
+
+# Textnachricht über den Versand-Thread senden; status=True für Zwischenmeldungen,
+# die entfallen, wenn kurz darauf eine weitere Nachricht folgt
+def send_text(room_id, text, status=False):
+    return outbound_sender.send(room_id, {"msgtype": "m.text", "body": text}, status=status)
+
+# Gesendete Nachricht per m.replace bearbeiten
+def edit_text(room_id, event_id, text):
+    content = {
+        "msgtype": "m.text",
+        "body": f"* {text}",
+        "m.new_content": {
+            "msgtype": "m.text",
+            "body": text
+        },
+        "m.relates_to": {
+            "rel_type": "m.replace",
+            "event_id": event_id
+        }
     }
-    config["scheduled_messages"].append(new_message)
-    save_config(config)
-    schedule_message(new_message)
-    return message_id
-
-# Nachricht senden
-def send_scheduled_message(message_data):
-    room_id = message_data["room_id"]
-    message = message_data["message"]
-    
-    if room_id not in rooms:
+    return outbound_sender.send(room_id, content, replaces=event_id)
+
+# Schrittweise wachsende Antwort (KI-Streaming, Teiltranskripte): erste Nachricht beim
+# ersten Text, danach gedrosselte Bearbeitungen
+class StreamingReply:
+    def __init__(self, room_id, prefix, interval=AI_STREAM_EDIT_INTERVAL):
+        self.room_id = room_id
+        self.prefix = prefix
+        self.interval = interval
+        self.event_id = None
+        self.first = None
+        self.shown_text = None
+        self.last_update = 0
+
+    def update(self, text):
+        if self.event_id is not None and time.monotonic() - self.last_update < self.interval:
+            return
+        self._show(text)
+
+    def finish(self, text):
+        if text == self.shown_text:
+            return
+        if not self._show(text):
+            # Die erste Nachricht hängt im Versand: Ergebnis als eigene Nachricht hinterherschicken
+            send_text(self.room_id, f"{self.prefix}{text}")
+
+    # Liefert False, wenn die erste Nachricht nach SEND_WAIT_TIMEOUT noch nicht gesendet ist
+    def _show(self, text):
+        body = f"{self.prefix}{text}"
+        if self.first is None:
+            self.first = send_text(self.room_id, body)
+        elif self.event_id is not None:
+            edit_text(self.room_id, self.event_id, body)
+        else:
+            # Text der noch wartenden ersten Nachricht kann nicht mehr geändert werden
+            body = None
+        if self.event_id is None:
+            # Auf die Event-ID warten, sie wird für die Bearbeitungen gebraucht
+            if not self.first.done.wait(SEND_WAIT_TIMEOUT):
+                return False
+            self.event_id = self.first.wait()
+            if body is None:
+                edit_text(self.room_id, self.event_id, f"{self.prefix}{text}")
+        self.shown_text = text
+        self.last_update = time.monotonic()
+        return True
+
+# Timeout für einen Host bestimmen
+def http_timeout(url):
+    host = urlparse(url).hostname or ""
+    return HTTP_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)
+
+# HTTP-Adapter mit Verbindungspool, der Anfragen ohne Timeout einen Standard-Timeout gibt
+class PooledHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout=None, **kwargs):
+        self.default_timeout = timeout
+        kwargs.setdefault("pool_connections", HTTP_POOL_CONNECTIONS)
+        kwargs.setdefault("pool_maxsize", HTTP_POOL_MAXSIZE)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.default_timeout or http_timeout(request.url)
+        return super().send(request, **kwargs)
+
+# Adapter in eine Session einhängen
+def mount_pooled_adapter(session, timeout=None):
+    adapter = PooledHTTPAdapter(timeout=timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Gemeinsame HTTP-Session mit Keep-Alive, wird beim ersten Aufruf erzeugt
+def get_http_session():
+    global http_session
+    if http_session is None:
+        with http_session_lock:
+            if http_session is None:
+                http_session = mount_pooled_adapter(requests.Session())
+    return http_session
+
+# HTTP-Anfrage über die gemeinsame Session
+def http_request(method, url, **kwargs):
+    return get_http_session().request(method, url, **kwargs)
+
+# Gleichzeitige Aufrufe mit gleichem Schlüssel teilen sich eine Ausführung
+class SingleFlight:
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
         try:
-            rooms[room_id] = client.join_room(room_id)
+            call.result = func(*args)
+            return call.result
         except Exception as e:
-            print(f"Konnte Raum nicht beitreten: {str(e)}")
-            return
-    
-    rooms[room_id].send_text(f"[Geplante Nachricht] {message}")
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def pending(self):
+        with self.lock:
+            return len(self.calls)
+
+# Schutzschalter für ein externes Backend: nach threshold Fehlschlägen in Folge werden
+# Anfragen für cooldown Sekunden sofort abgelehnt, danach darf eine einzelne Probe durch.
+# Gelingt sie, schließt der Schalter wieder, sonst bleibt er offen.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    # True, wenn eine Anfrage gestellt werden darf
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    # Sekunden bis zum nächsten Probeversuch
+    def retry_in(self):
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.opened_at + self.cooldown - time.monotonic())
+
+    def describe(self):
+        with self.lock:
+            state, failures, trips = self.state, self.failures, self.trips
+        if state == self.CLOSED:
+            text = "geschlossen" if not failures else f"geschlossen ({failures} Fehlschläge in Folge)"
+        elif state == self.HALF_OPEN:
+            text = "Probeversuch läuft"
+        else:
+            text = f"offen, nächster Versuch in {self.retry_in():.0f}s"
+        return f"{text}, {trips}x ausgelöst"
+
+# Ringpuffer der letzten m.room.message-Events eines Raums (älteste zuerst)
+class RoomEventBuffer:
+    def __init__(self, maxlen=RECENT_EVENTS_PER_ROOM):
+        self.events = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+        # Nach einem Nachladen ist der Puffer vollständig, der Listener hält ihn aktuell
+        self.backfilled = False
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def latest(self, limit):
+        with self.lock:
+            return list(self.events)[-limit:]
+
+    # Ältere Events aus /messages (neueste zuerst) vorne einfügen
+    def add_older(self, chunk):
+        with self.lock:
+            known = {event.get('event_id') for event in self.events}
+            older = [event for event in reversed(chunk)
+                     if event.get('type') == 'm.room.message' and event.get('event_id') not in known]
+            self.events = deque((older + list(self.events))[-self.events.maxlen:], maxlen=self.events.maxlen)
+            self.backfilled = True
+
+# Puffer eines Raums holen oder anlegen
+def get_event_buffer(room_id):
+    with recent_events_lock:
+        buffer = recent_events.get(room_id)
+        if buffer is None:
+            buffer = recent_events[room_id] = RoomEventBuffer()
+        return buffer
+
+# Raumverlauf über /messages nachladen
+def backfill_room_events(room, buffer, limit):
+    from_token = room.prev_batch if hasattr(room, 'prev_batch') else None
+    if from_token is None:
+        # Auch next_batch aus /sync ist ein gültiger Startpunkt, z.B. für wieder angelegte Räume
+        from_token = client.sync_token
     
-    # Für nicht-wiederholende Nachrichten
-    if not message_data["repeat"]:
-        config = load_config()
-        config["scheduled_messages"] = [m for m in config["scheduled_messages"] if m["id"] != message_data["id"]]
-        save_config(config)
-        # Alle Jobs mit diesem Tag entfernen
-        schedule.clear(f"once_{message_data['id']}")
-
-# Nachricht planen
-def schedule_message(message_data):
-    schedule_time = message_data["schedule_time"]
-    time_parts = schedule_time.split(":")
-    hour, minute = int(time_parts[0]), int(time_parts[1])
+    if from_token is None:
+        # Wenn kein Token verfügbar ist, führe einen Sync durch um einen zu bekommen
+        sync_response = client.api.sync(timeout_ms=30000, filter=client.sync_filter)
+        from_token = sync_response['rooms']['join'][room.room_id]['timeline']['prev_batch']
     
-    if message_data["repeat"] == "daily":
-        schedule.every().day.at(schedule_time).do(send_scheduled_message, message_data).tag(f"daily_{message_data['id']}")
-    elif message_data["repeat"] == "weekdays":
-        schedule.every().monday.at(schedule_time).do(send_scheduled_message, message_data).tag(f"weekday_{message_data['id']}")
-        schedule.every().tuesday.at(schedule_time).do(send_scheduled_message, message_data).tag(f"weekday_{message_data['id']}")
-        schedule.every().wednesday.at(schedule_time).do(send_scheduled_message, message_data).tag(f"weekday_{message_data['id']}")
-        schedule.every().thursday.at(schedule_time).do(send_scheduled_message, message_data).tag(f"weekday_{message_data['id']}")
-        schedule.every().friday.at(schedule_time).do(send_scheduled_message, message_data).tag(f"weekday_{message_data['id']}")
-    elif message_data["repeat"] == "weekly":
-        schedule.every().week.at(schedule_time).do(send_scheduled_message, message_data).tag(f"weekly_{message_data['id']}")
-    else:
-        # Einmalige Ausführung
-        now = datetime.datetime.now()
-        target_time = now.replace(hour=hour, minute=minute, second=0)
-        if target_time < now:
-            target_time = target_time + datetime.timedelta(days=1)
-        
-        delay = (target_time - now).total_seconds()
-        if delay > 0:
-            schedule.every(delay).seconds.do(send_scheduled_message, message_data).tag(f"once_{message_data['id']}")
+    room_events = client.api.get_room_messages(
+        room.room_id, 
+        from_token, 
+        direction='b',  # backwards in time
+        limit=limit
+    )
+    buffer.add_older(room_events['chunk'])
+
+# Letzte Nachrichten eines Raums (älteste zuerst) aus dem Puffer holen.
+# Nur wenn der Puffer zu wenige Events und kein passendes Event enthält, wird nachgeladen.
+def get_recent_room_events(room, limit, predicate=None):
+    buffer = get_event_buffer(room.room_id)
+    events = buffer.latest(limit)
+    if not buffer.backfilled and len(events) < limit:
+        if predicate is None or not any(predicate(event) for event in events):
+            backfill_room_events(room, buffer, limit)
+            events = buffer.latest(limit)
+    return events
+
+# Prüfen, ob ein Event eine Sprachnachricht ist
+def is_audio_event(event):
+    return event['type'] == 'm.room.message' and event['content'].get('msgtype') == 'm.audio'
 
 # Hilfsfunktion für Befehlsverarbeitung
 def parse_command(message):
@@ -187,274 +1536,125 @@ def parse_command(message):
     args = parts[1] if len(parts) > 1 else ""
     return command, args
 
-# Befehlsverarbeitung
-def process_command(room, sender, command, args):
-    if command == "!help":
-        help_text = """**Matrix All-in-One Bot**
+# Prüfen, ob ein Feature in dieser Instanz angeboten wird
+def feature_enabled(name):
+    return ENABLED_FEATURES is None or name in ENABLED_FEATURES
 
-**Transkription:**
-!transcribe - Transkribiert die letzte Sprachnachricht
+# Feature-Modul beim ersten Aufruf importieren, einrichten und seine Befehle registrieren
+def load_feature(name):
+    feature = features.get(name)
+    if feature is not None:
+        return feature
+    with features_lock:
+        feature = features.get(name)
+        if feature is None:
+            started = time.monotonic()
+            feature = importlib.import_module(f"features.{name}")
+            if hasattr(feature, "setup"):
+                feature.setup()
+            command_handlers.update(feature.COMMANDS)
+            features[name] = feature
+            print(f"Feature {name} geladen ({time.monotonic() - started:.2f}s)")
+    return feature
 
-**KI-Chat:**
-!ai [Nachricht] - Fragt die KI nach einer Antwort
+# Handler eines Befehls; das zuständige Feature wird bei Bedarf geladen
+def get_command_handler(command):
+    handler = command_handlers.get(command)
+    if handler is None:
+        name = FEATURE_COMMANDS.get(command)
+        if name is not None and feature_enabled(name):
+            handler = load_feature(name).COMMANDS.get(command)
+    return handler
 
-**Geplante Nachrichten:**
+# Hilfetext, nur mit den Befehlen der angebotenen Features
+def send_help(room, sender, args):
+    sections = [("transcription", """**Transkription:**
+!transcribe - Transkribiert die letzte Sprachnachricht"""), ("ai", """**KI-Chat:**
+!ai [Nachricht] - Fragt die KI nach einer Antwort"""), ("scheduling", """**Geplante Nachrichten:**
 !schedule add HH:MM [Nachricht] - Einmalige Nachricht planen
 !schedule daily HH:MM [Nachricht] - Tägliche Nachricht planen
 !schedule weekly HH:MM [Nachricht] - Wöchentliche Nachricht planen
 !schedule weekdays HH:MM [Nachricht] - Nachricht an Wochentagen planen
 !schedule list - Geplante Nachrichten anzeigen
-!schedule remove [ID] - Geplante Nachricht entfernen
+!schedule remove [ID] - Geplante Nachricht entfernen oder eingehende Rundsendung abbestellen
+!schedule timezone [Zone] - Zeitzone des Raums anzeigen oder setzen (z.B. Europe/Berlin)
+!schedule broadcast [Ziel] [add|daily|weekly|weekdays] HH:MM [Nachricht] - Rundsendung an tag:Name (nur Moderatoren) oder Raum1,Raum2 (nur Admins)
+!schedule incoming - Rundsendungen anderer Räume an diesen Raum anzeigen
+!schedule tag [Name] - Raum einem Tag für Rundsendungen zuordnen (ohne Name: Tags anzeigen, sonst nur Moderatoren)
+!schedule untag [Name] - Raum aus einem Tag entfernen (nur Moderatoren)
+!schedule results [ID] - Ergebnis der letzten Rundsendung anzeigen
+Zeitangaben können eine eigene Zeitzone haben: HH:MM@Europe/Berlin""")]
+    other = "**Sonstiges:**\n!help - Diese Hilfe anzeigen"
+    if feature_enabled("status"):
+        other += "\n!status - Bot-Status anzeigen"
+    if feature_enabled("debug") and is_admin(sender):
+        other += "\n!debug profile [Sekunden] - CPU-Profil aller Threads aufnehmen\n!debug mem [stop] - Speicher-Schnappschuss und Zuwachs seit dem letzten"
+    help_text = "\n\n".join(["**Matrix All-in-One Bot**"] + [text for name, text in sections if feature_enabled(name)] + [other])
+    send_text(room.room_id, help_text)
 
-**Sonstiges:**
-!help - Diese Hilfe anzeigen
-!status - Bot-Status anzeigen"""
-        room.send_text(help_text)
-        return True
-    
-    elif command == "!ai":
-        # if not args:
-        #     room.send_text("Bitte gib eine Nachricht für die KI an.")
-        #     return True
-        
-        # Nachrichten aus dem Raumverlauf abrufen (die letzten 10)
-        try:
-            from_token = room.prev_batch if hasattr(room, 'prev_batch') else None
-            
-            if from_token is None:
-                # Wenn kein Token verfügbar ist, führe einen Sync durch um einen zu bekommen
-                sync_response = client.api.sync(timeout_ms=30000)
-                from_token = sync_response['rooms']['join'][room.room_id]['timeline']['prev_batch']
-            
-            room_events = client.api.get_room_messages(
-                room.room_id, 
-                from_token, 
-                direction='b',  # backwards in time
-                limit=10
-            )
-            
-            # Nachrichtenverlauf aus den letzten Nachrichten extrahieren
-            message_history = []
-            last_user_message = None
-            last_user = None
-            
-            for event in reversed(room_events['chunk']):
-                if event['type'] == 'm.room.message' and event['content'].get('msgtype') == 'm.text':
-                    # if event['sender'] != client.user_id:  # Keine Bot-Nachrichten
-                    message_text = event['content']['body'].strip()
-                    if not message_text.startswith("!"):  # Keine Befehle
-                        sender_name = event['sender'].split(":")[-2].split("@")[-1]  # Einfache Namensextraktion
-                        message_history.append(f"{sender_name}: {message_text}")
-                        
-                        # Speichere den letzten Nutzer und seine Nachricht
-                        if event['sender'] != sender:  # Wenn es nicht vom aktuellen Befehlsgeber ist
-                            last_user = sender_name
-                            last_user_message = message_text
-            
-            # Kontext für den KI-Prompt erstellen
-            context = "\n".join(message_history[-5:])  # Letzte 5 Nachrichten für Kontext
-            
-            # KI-Prompt erstellen
-            prompt = f"""
-    Hier ist ein Auszug aus einer aktuellen Konversation:
-
-    {context}
-
-    Der Nutzer '{last_user}' hat zuletzt geschrieben: "{last_user_message}"
-
-    Bitte antworte im Kontext dieser Konversation und ahme den Sprachstil von '{last_user}' nach. Beziehe dich auf den Inhalt der letzten Nachricht, wenn möglich.
-
-    Anfrage: {args}
-    """
-            
-            room.send_text("Frage KI... (dies kann einen Moment dauern)")
-            ai_response = get_ai_response(prompt)
-            room.send_text(f"KI-Antwort: {ai_response}")
-        
-        except Exception as e:
-            # Fallback bei Fehler: Normale KI-Anfrage ohne Kontext
-            room.send_text("Frage KI... (ohne Konversationskontext)")
-            ai_response = get_ai_response(args)
-            room.send_text(f"KI-Antwort: {ai_response}")
-        
-        return True
-    
-    elif command == "!transcribe":
-        room.send_text("Suche nach der letzten Sprachnachricht...")
-        try:
-            # Nachrichten aus dem Raumverlauf abrufen (die letzten 50)
-            # Die direction "b" bedeutet "backwards" (rückwärts in der Zeit)
-            from_token = room.prev_batch if hasattr(room, 'prev_batch') else None
-            
-            if from_token is None:
-                # Wenn kein Token verfügbar ist, führe einen Sync durch um einen zu bekommen
-                sync_response = client.api.sync(timeout_ms=30000)
-                from_token = sync_response['rooms']['join'][room.room_id]['timeline']['prev_batch']
-            
-            room_events = client.api.get_room_messages(
-                room.room_id, 
-                from_token, 
-                direction='b',  # backwards in time
-                limit=50
-            )
-            
-            # Nach Sprachnachrichten suchen
-            audio_events = []
-            for event in room_events['chunk']:
-                if event['type'] == 'm.room.message' and event['content'].get('msgtype') == 'm.audio':
-                    audio_events.append(event)
-            
-            if not audio_events:
-                room.send_text("Keine Sprachnachrichten in den letzten 50 Nachrichten gefunden.")
-                return True
-            
-            # Die neueste Sprachnachricht verwenden
-            latest_audio = audio_events[0]
-            mxc_url = latest_audio['content'].get('url')
-            
-            if mxc_url:
-                # MXC-URL in HTTP-URL umwandeln
-                http_url = client.api.get_download_url(mxc_url)
-                room.send_text("Transkribiere Sprachnachricht...")
-                transcription = transcribe_audio(http_url)
-                room.send_text(f"Transkription: {transcription}")
-            else:
-                room.send_text("Fehler: Keine URL für die Audiodatei gefunden.")
-        except Exception as e:
-            room.send_text(f"Fehler beim Zugriff auf den Raumverlauf: {str(e)}")
-            import traceback
-            traceback.print_exc()  # Detaillierteren Fehler in der Konsole ausgeben
-        
-        return True
-    
-    elif command == "!status":
-        config = load_config()
-        active_rooms = len(rooms)
-        scheduled_msgs = len(config["scheduled_messages"])
-        uptime = time.time() - start_time
-        hours, remainder = divmod(uptime, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        
-        status_text = f"""**Bot-Status:**
-Bot aktiv seit: {int(hours)}h {int(minutes)}m {int(seconds)}s
-Aktive Räume: {active_rooms}
-Geplante Nachrichten: {scheduled_msgs}"""
-        room.send_text(status_text)
-        return True
-    
-    elif command == "!schedule":
-        if not args:
-            room.send_text("Bitte gib einen Unterbefehl an. !help für Hilfe.")
-            return True
-        
-        schedule_parts = args.split(" ", 1)
-        subcmd = schedule_parts[0].lower()
-        subargs = schedule_parts[1] if len(schedule_parts) > 1 else ""
-        
-        if subcmd == "list":
-            config = load_config()
-            room_messages = [m for m in config["scheduled_messages"] if m["room_id"] == room.room_id]
-            if room_messages:
-                message_list = "\n".join([f"ID {m['id']}: {m['schedule_time']} - {m['message'][:30]}..." for m in room_messages])
-                room.send_text(f"Geplante Nachrichten:\n{message_list}")
-            else:
-                room.send_text("Keine geplanten Nachrichten für diesen Raum.")
-            return True
-        
-        elif subcmd == "remove":
-            try:
-                msg_id = int(subargs)
-                config = load_config()
-                
-                # Prüfen, ob Nachricht existiert
-                message = next((m for m in config["scheduled_messages"] if m["id"] == msg_id), None)
-                if not message:
-                    room.send_text(f"Keine Nachricht mit ID {msg_id} gefunden.")
-                    return True
-                
-                # Prüfen, ob Benutzer berechtigt ist (nur im gleichen Raum)
-                if message["room_id"] != room.room_id:
-                    room.send_text("Du kannst nur Nachrichten aus diesem Raum entfernen.")
-                    return True
-                
-                # Nachricht entfernen
-                config["scheduled_messages"] = [m for m in config["scheduled_messages"] if m["id"] != msg_id]
-                save_config(config)
-                
-                # Alle Jobs mit diesem Tag entfernen
-                schedule.clear(f"once_{msg_id}")
-                schedule.clear(f"daily_{msg_id}")
-                schedule.clear(f"weekly_{msg_id}")
-                schedule.clear(f"weekday_{msg_id}")
-                
-                room.send_text(f"Nachricht mit ID {msg_id} entfernt.")
-            except ValueError:
-                room.send_text("Bitte gib eine gültige ID an.")
-            except Exception as e:
-                room.send_text(f"Fehler: {str(e)}")
-            return True
-        
-        elif subcmd in ["add", "daily", "weekly", "weekdays"]:
-            repeat = None if subcmd == "add" else subcmd
-            
-            try:
-                time_parts = subargs.split(" ", 1)
-                if len(time_parts) != 2:
-                    room.send_text("Bitte gib Zeit und Nachricht an.")
-                    return True
-                
-                time_str = time_parts[0]
-                msg_text = time_parts[1]
-                
-                # Zeit validieren
-                try:
-                    hour, minute = map(int, time_str.split(":"))
-                    if not (0 <= hour < 24 and 0 <= minute < 60):
-                        raise ValueError()
-                except:
-                    room.send_text("Bitte gib die Zeit im Format HH:MM an.")
-                    return True
-                
-                # Nachricht planen
-                msg_id = add_scheduled_message(room.room_id, msg_text, time_str, repeat)
-                
-                if repeat:
-                    room.send_text(f"{repeat.capitalize()} Nachricht für {time_str} geplant. ID: {msg_id}")
-                else:
-                    room.send_text(f"Einmalige Nachricht für {time_str} geplant. ID: {msg_id}")
-                
-            except Exception as e:
-                room.send_text(f"Fehler: {str(e)}")
-            return True
-        
-        else:
-            room.send_text(f"Unbekannter Unterbefehl: {subcmd}. !help für Hilfe.")
-            return True
-    
-    return False
+command_handlers["!help"] = send_help
+
+# Befehlsverarbeitung über die Befehlstabelle
+def process_command(room, sender, command, args):
+    handler = get_command_handler(command)
+    if handler is None:
+        return False
+    handler(room, sender, args)
+    return True
 
 # Event-Handler für eingehende Nachrichten
 def on_message(room, event):
     # Doppelte Events vermeiden
     event_id = event.get('event_id', '')
-    if event_id in processed_events:
+    if not processed_events.add(event_id):
         return
-    processed_events.add(event_id)
-    
-    # Maximale Anzahl verarbeiteter Events begrenzen
-    if len(processed_events) > 1000:
-        processed_events.clear()
     
     # Nur Nachrichten verarbeiten
     if event['type'] != "m.room.message":
         return
     
-    sender = event['sender']
+    # Für !ai und !transcribe im Raumpuffer festhalten (auch eigene Nachrichten)
+    get_event_buffer(room.room_id).add(event)
     
     # Eigene Nachrichten ignorieren
-    if sender == client.user_id:
+    if event['sender'] == client.user_id:
         return
     
+    # Nur Text- und Sprachnachrichten werden weiterverarbeitet
+    if event['content'].get('msgtype', '') not in ("m.text", "m.audio"):
+        return
+    
+    # Räume anderer Instanzen nur mitlesen
+    if shard_coordinator is not None and not shard_coordinator.owns_room(room.room_id):
+        return
+    
+    # Verzögerung vom Senden auf dem Homeserver bis zum Listener
+    if 'origin_server_ts' in event:
+        metrics.observe("bot_event_lag_seconds", max(0.0, time.time() - event['origin_server_ts'] / 1000))
+    
+    # Gewöhnlicher Chat belegt keinen Platz in der Warteschlange des Raums
+    if not needs_handling(room, event):
+        return
+    
+    # Verarbeitung an den Worker-Pool übergeben, damit der Listener-Thread frei bleibt
+    if not executor.submit(room.room_id, handle_message, room, event):
+        print(f"Zu viele wartende Befehle in Raum {room.room_id}, Event {event_id} verworfen")
+
+# Auf dem Listener-Thread prüfen, ob ein Event Arbeit erzeugt: Befehl, Ansprache des Bots
+# oder Sprachnachricht in einem Raum mit automatischer Transkription
+def needs_handling(room, event):
+    msg_type = event['content'].get('msgtype', '')
+    if msg_type == "m.text":
+        message = event['content'].get('body', '').strip()
+        return message.startswith(("!", f"@{USERNAME}", client.user_id))
+    if msg_type == "m.audio":
+        return (AUTO_TRANSCRIBE or config_store.is_auto_transcribe_room(room.room_id)) and feature_enabled("transcription")
+    return False
+
+# Nachricht im Worker-Thread verarbeiten
+def handle_message(room, event):
+    sender = event['sender']
+    
     # Nachrichtentyp prüfen
     msg_type = event['content'].get('msgtype', '')
     
@@ -465,119 +1665,415 @@ def on_message(room, event):
         # Auf Befehle prüfen
         if message.startswith("!"):
             command, args = parse_command(message)
+            started = time.monotonic()
             if process_command(room, sender, command, args):
+                metrics.inc("bot_commands_total", {"command": command})
+                metrics.observe("bot_command_seconds", time.monotonic() - started, {"command": command})
                 return
         
         # Bot direkt ansprechen
         if message.startswith(f"@{USERNAME}") or message.startswith(client.user_id):
             # Ansprache entfernen
             user_message = message.replace(f"@{USERNAME}", "").replace(client.user_id, "").strip()
-            if user_message:
-                room.send_text("Frage KI... (dies kann einen Moment dauern)")
-                ai_response = get_ai_response(user_message)
-                room.send_text(f"KI-Antwort: {ai_response}")
+            if user_message and feature_enabled("ai"):
+                with metrics.timer("bot_command_seconds", {"command": "mention"}):
+                    load_feature("ai").answer_in_context(room, sender, user_message)
+                metrics.inc("bot_commands_total", {"command": "mention"})
     
 # Sprachnachrichten transkribieren
     elif msg_type == "m.audio":
         # Automatische Transkription, wenn der Bot direkt konfiguriert ist
-        auto_transcribe = False  # Auf True setzen für automatische Transkription
-        
-        if auto_transcribe or any(room.room_id == r_id for r_id in load_config().get("auto_transcribe_rooms", [])):
-            mxc_url = event['content'].get('url')
-            if mxc_url:
-                room.send_text("Transkribiere Sprachnachricht...")
-                # MXC-URL in HTTP-URL umwandeln
-                http_url = client.api.get_download_url(mxc_url)
-                transcription = transcribe_audio(http_url)
-                room.send_text(f"Transkription: {transcription}")
+        if (AUTO_TRANSCRIBE or config_store.is_auto_transcribe_room(room.room_id)) and feature_enabled("transcription"):
+            load_feature("transcription").handle_audio_message(room, event)
 
 # Einladungen annehmen
 def on_invite(room_id, state):
+    # Mit mehreren Instanzen nimmt nur die zuständige Instanz die Einladung an
+    if shard_coordinator is not None and not shard_coordinator.owns_room(room_id):
+        return
     try:
         room = client.join_room(room_id)
-        rooms[room_id] = room
-        room.add_listener(on_message)
+        register_room(room)
         
         # Raum zur Konfiguration hinzufügen
-        config = load_config()
-        if room_id not in config["joined_rooms"]:
-            config["joined_rooms"].append(room_id)
-            save_config(config)
+        config_store.add_joined_room(room_id)
         
-        room.send_text("Hallo! Ich bin ein All-in-One Matrix-Bot mit Funktionen für Transkription, KI-Chat und geplante Nachrichten. Schreibe `!help` für eine Liste aller Befehle.")
+        send_text(room.room_id, "Hallo! Ich bin ein All-in-One Matrix-Bot mit Funktionen für Transkription, KI-Chat und geplante Nachrichten. Schreibe `!help` für eine Liste aller Befehle.")
     except Exception as e:
         print(f"Fehler beim Beitreten zum Raum {room_id}: {str(e)}")
 
-# Alle geplanten Nachrichten laden und planen
-def load_all_scheduled_messages():
-    config = load_config()
-    for message_data in config["scheduled_messages"]:
-        schedule_message(message_data)
+# Sync-Token laden und speichern
+def load_sync_token():
+    try:
+        with open(SYNC_STATE_FILE, "r") as f:
+            return json.load(f).get("next_batch")
+    except (FileNotFoundError, ValueError):
+        return None
 
-# Scheduler-Thread
-def scheduler_thread():
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+def save_sync_token(token):
+    write_json_atomic(SYNC_STATE_FILE, {"next_batch": token})
 
-# Hauptfunktion
-def main():
-    global client, start_time
+# Sync-Filter hochladen und für den Listener verwenden
+def apply_sync_filter():
+    if SYNC_FILTER is None:
+        return
+    sync_filter = SYNC_FILTER
+    if LIGHTWEIGHT_ROOMS:
+        # Mitglieder werden nicht verwaltet, also auch nicht geladen
+        sync_filter = dict(SYNC_FILTER, room=dict(SYNC_FILTER.get("room", {}), state={"not_types": ["*"]}))
+    response = client.api.create_filter(client.user_id, sync_filter)
+    client.sync_filter = response["filter_id"]
+
+# Darf der Benutzer Admin-Befehle verwenden?
+def is_admin(user_id):
+    return user_id in ADMIN_USERS
+
+# Kompakter Raum für LIGHTWEIGHT_ROOMS: nur Raum-ID, Token für das Nachladen des Verlaufs
+# und Zeitpunkt der letzten Nachricht. Erfüllt die Schnittstelle, die MatrixClient._sync
+# von einem Raum erwartet, speichert aber weder Zustand noch Mitglieder noch Events.
+class RoomHandle:
+    __slots__ = ("room_id", "prev_batch", "last_active")
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.prev_batch = None
+        self.last_active = time.monotonic()
+
+    def send_text(self, text):
+        return send_text(self.room_id, text)
+
+    def _process_state_event(self, event):
+        pass
+
+    def _put_event(self, event):
+        pass
+
+    def _put_ephemeral_event(self, event):
+        pass
+
+# MatrixClient, der für jeden Raum nur ein RoomHandle anlegt (auch bei join_room).
+# Events kommen über den Client-Listener on_room_event.
+class LeanMatrixClient(MatrixClient):
+    def __init__(self, *args, **kwargs):
+        # Vor super().__init__, das mit einem Token bereits _sync aufruft
+        self.last_evict = time.monotonic()
+        super().__init__(*args, **kwargs)
+
+    def _mkroom(self, room_id):
+        room = self.rooms[room_id] = RoomHandle(room_id)
+        return room
+
+    # Inaktive Räume zwischen zwei Syncs im Listener-Thread entfernen: _sync legt Räume in
+    # self.rooms an und liest sie gleich wieder, ein anderer Thread darf sie nicht entfernen
+    def _sync(self, timeout_ms=30000):
+        super()._sync(timeout_ms)
+        if time.monotonic() - self.last_evict >= ROOM_EVICT_INTERVAL:
+            self.last_evict = time.monotonic()
+            evicted = evict_idle_rooms()
+            if evicted:
+                print(f"{evicted} inaktive Räume aus dem Speicher genommen")
+
+# Raum registrieren; ohne LIGHTWEIGHT_ROOMS mit eigenem Listener pro Raum
+def register_room(room):
+    rooms[room.room_id] = room
+    if not LIGHTWEIGHT_ROOMS:
+        room.add_listener(on_message)
+    return room
+
+# Raum aus dem Speicher holen oder für einen beigetretenen, verdrängten Raum neu anlegen.
+# None, wenn der Bot nicht im Raum ist.
+def get_room(room_id):
+    room = rooms.get(room_id)
+    if room is None and config_store.is_joined_room(room_id):
+        room = register_room(client.rooms.get(room_id) or client._mkroom(room_id))
+    return room
+
+# Client-Listener für LIGHTWEIGHT_ROOMS: Nachrichten aller Räume an on_message weitergeben
+def on_room_event(event):
+    room_id = event["room_id"]
+    # Verdrängte Räume werden hier wieder angelegt (MatrixClient._sync hat den Handle schon erzeugt)
+    room = rooms.get(room_id) or register_room(client.rooms.get(room_id) or client._mkroom(room_id))
+    room.last_active = time.monotonic()
+    on_message(room, event)
+
+# Erster vollständiger Sync. Bei vielen Räumen braucht Synapse dafür länger als das
+# Lese-Timeout aus HTTP_MATRIX_TIMEOUT; es rechnet aber weiter und hält die Antwort bereit,
+# sodass ein erneuter Versuch sie bekommt. Daher bei Zeitüberschreitung und Serverfehlern
+# mit wachsender Pause wiederholen.
+def initial_sync():
+    delay = LISTENER_RETRY_DELAY
+    for attempt in range(1, INITIAL_SYNC_ATTEMPTS + 1):
+        try:
+            client._sync()
+            return
+        except (MatrixHttpLibError, MatrixRequestError) as e:
+            if isinstance(e, MatrixRequestError) and e.code < 500 or attempt == INITIAL_SYNC_ATTEMPTS:
+                raise
+            print(f"Initialer Sync fehlgeschlagen ({attempt}/{INITIAL_SYNC_ATTEMPTS}): {str(e)}. Neuer Versuch in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, LISTENER_RETRY_MAX_DELAY)
+
+# Fehler im Listener-Thread (z.B. MatrixHttpLibError bei Zeitüberschreitung oder nicht
+# erreichbarem Homeserver): protokollieren, mit wachsender Pause warten und weiter
+# synchronisieren, statt den Thread (und damit den Empfang) zu beenden. Hat sich der
+# Sync-Token seit dem letzten Fehler geändert, lief zwischendurch ein Sync durch.
+def on_listener_error(e):
+    global listener_failures, listener_failure_token
+    if client.sync_token != listener_failure_token:
+        listener_failures = 0
+    listener_failures += 1
+    listener_failure_token = client.sync_token
+    delay = min(LISTENER_RETRY_DELAY * 2 ** (listener_failures - 1), LISTENER_RETRY_MAX_DELAY)
+    metrics.inc("bot_sync_errors_total", {"type": type(e).__name__})
+    print(f"Fehler beim Synchronisieren: {str(e)}. Neuer Versuch in {delay:.0f}s")
+    time.sleep(delay)
+
+# Räume ohne Nachrichten seit ROOM_IDLE_EVICT_SECONDS aus dem Speicher nehmen: Raum, Nachrichtenpuffer,
+# Token-Bucket und was Features über evict_room(room_id) freigeben. Der Bot bleibt im Raum;
+# beim nächsten Event oder Befehl wird er neu angelegt und der Verlauf bei Bedarf nachgeladen.
+# Wird von LeanMatrixClient._sync im Listener-Thread aufgerufen.
+def evict_idle_rooms():
+    if not LIGHTWEIGHT_ROOMS or ROOM_IDLE_EVICT_SECONDS is None:
+        return 0
+    cutoff = time.monotonic() - ROOM_IDLE_EVICT_SECONDS
+    evicted = 0
+    for room_id, room in list(rooms.items()):
+        if room.last_active > cutoff or executor.busy(room_id):
+            continue
+        rooms.pop(room_id, None)
+        client.rooms.pop(room_id, None)
+        with recent_events_lock:
+            recent_events.pop(room_id, None)
+        outbound_sender.forget_room(room_id)
+        for feature in list(features.values()):
+            if hasattr(feature, "evict_room"):
+                feature.evict_room(room_id)
+        evicted += 1
+    if evicted:
+        metrics.inc("bot_rooms_evicted_total", value=evicted)
+    return evicted
+
+# Ungefährer Speicherbedarf eines Objekts mit allen enthaltenen Containern und Zeichenketten
+def deep_sizeof(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+# Speicher eines Raums: Raumobjekt (ohne Verweis auf den Client) und Nachrichtenpuffer
+def room_memory(room_id, room):
+    seen = set()
+    if hasattr(room, "__dict__"):
+        size = sys.getsizeof(room) + deep_sizeof({key: value for key, value in vars(room).items() if key != "client"}, seen)
+    else:
+        size = sys.getsizeof(room) + deep_sizeof(room.room_id, seen)
+    buffer = recent_events.get(room_id)
+    if buffer is not None:
+        size += deep_sizeof(buffer.events, seen)
+    return size
+
+# Durchschnittlicher Speicher pro Raum und Summe, geschätzt aus höchstens sample Räumen
+def room_memory_estimate(sample=ROOM_MEMORY_SAMPLE):
+    items = list(rooms.items())
+    if not items:
+        return 0, 0
+    picked = items[::max(1, len(items) // sample)][:sample]
+    average = sum(room_memory(room_id, room) for room_id, room in picked) / len(picked)
+    return average, average * len(items)
+
+# Raum beitreten, Fehler nur protokollieren
+def join_room_safely(room_id):
+    try:
+        return client.join_room(room_id)
+    except Exception as e:
+        print(f"Fehler beim Beitreten zum Raum {room_id}: {str(e)}")
+        return None
+
+# Räume beim Start verbinden: bereits beigetretene Räume ohne Join-Aufruf anhängen,
+# die übrigen parallel mit begrenzter Anzahl gleichzeitiger Beitritte beitreten
+def attach_rooms(room_ids, joined_room_ids):
+    to_join = []
+    for room_id in dict.fromkeys(room_ids):
+        if room_id in rooms:
+            continue
+        if room_id in joined_room_ids:
+            register_room(client.rooms.get(room_id) or client._mkroom(room_id))
+            config_store.add_joined_room(room_id)
+        else:
+            to_join.append(room_id)
+    
+    if to_join:
+        with ThreadPoolExecutor(max_workers=STARTUP_JOIN_PARALLELISM) as pool:
+            for room_id, room in zip(to_join, pool.map(join_room_safely, to_join)):
+                if room is not None:
+                    register_room(room)
+                    config_store.add_joined_room(room_id)
+    return len(to_join)
+
+# Änderungen der anderen Instanzen übernehmen
+def apply_shared_changes():
+    changed, removed, room_ids, settings = config_store.poll()
+    if (changed or removed or "timezone" in settings) and feature_enabled("scheduling"):
+        load_feature("scheduling").apply_changes(changed, removed, settings)
+    # Von anderen Instanzen beigetretene Räume anhängen, falls sie später hierher wandern
+    if room_ids:
+        attach_rooms(room_ids, set(room_ids))
+
+# Importzeit und Speicherbedarf der Feature-Module messen (python bot.py --measure-imports).
+# Für eine Aufschlüsselung nach einzelnen Modulen: python -X importtime bot.py --measure-imports
+def measure_imports():
+    tracemalloc.start()
+    total = 0.0
+    print(f"{'Feature':<15} {'Zeit':>10} {'Speicher':>10}")
+    for name in dict.fromkeys(FEATURE_COMMANDS.values()):
+        memory_before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        importlib.import_module(f"features.{name}")
+        duration = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0] - memory_before
+        total += duration
+        enabled = "" if feature_enabled(name) else " (deaktiviert)"
+        print(f"{name:<15} {duration * 1000:8.1f}ms {memory / 1024 / 1024:8.1f}MB{enabled}")
+    print(f"{'Gesamt':<15} {total * 1000:8.1f}ms {tracemalloc.get_traced_memory()[0] / 1024 / 1024:8.1f}MB")
+
+# SIGUSR1: CPU-Profil, SIGUSR2: Speicher-Schnappschuss. Der Bericht wird in einem eigenen
+# Thread erstellt und auf der Konsole ausgegeben, die Dateien landen in PROFILE_DIR.
+def on_debug_signal(signum, frame):
+    action = "profile" if signum == signal.SIGUSR1 else "mem"
+    threading.Thread(target=lambda: print(load_feature("debug").run_report(action)), name="debug", daemon=True).start()
+
+# Signal-Handler installieren (nur im Haupt-Thread möglich, nicht unter Windows)
+def install_debug_signals():
+    if hasattr(signal, "SIGUSR1") and feature_enabled("debug"):
+        signal.signal(signal.SIGUSR1, on_debug_signal)
+        signal.signal(signal.SIGUSR2, on_debug_signal)
+
+# Bot einrichten: Konfiguration, Anmeldung, Räume, Worker und Scheduler.
+# Der Sync-Listener wird erst von main() gestartet.
+def start_bot():
+    global client, start_time, config_store, executor, startup_timer, outbound_sender, shard_coordinator
     
     # Startzeit festhalten
     start_time = time.time()
+    startup_timer = StartupTimer()
     
-    # Verbindung zur Matrix herstellen
-    client = MatrixClient(MATRIX_SERVER)
-    token = client.login(username=USERNAME, password=PASSWORD)
+    # Konfiguration einmalig laden und Schreib-Thread starten
+    with startup_timer.phase("Konfiguration"):
+        if SHARD_DB:
+            # Mehrere Instanzen: gemeinsame SQLite-Datei, CONFIG_FILE wird beim ersten Start übernommen
+            shard_coordinator = ShardCoordinator(
+                SharedStore(SHARD_DB), SHARD_ID or f"{socket.gethostname()}-{os.getpid()}", apply_shared_changes)
+            config_store = SqliteConfigStore(shard_coordinator.store, shard_coordinator.shard_id, CONFIG_FILE)
+        else:
+            config_store = ConfigStore(CONFIG_FILE)
+        config_store.start()
+    
+    # Verbindung zur Matrix herstellen. Mit gespeichertem Sync-Token entfällt der
+    # vollständige Sync beim Login, der Listener macht inkrementell weiter.
+    sync_token = load_sync_token()
+    with startup_timer.phase("Login"):
+        if LIGHTWEIGHT_ROOMS:
+            # Ohne Zustands- und Mitgliederverwaltung in matrix_client
+            client = LeanMatrixClient(MATRIX_SERVER, cache_level=CACHE.NONE)
+        else:
+            client = MatrixClient(MATRIX_SERVER)
+        # Auch die Matrix-API über einen Verbindungspool mit Timeouts laufen lassen
+        mount_pooled_adapter(client.api.session, timeout=HTTP_MATRIX_TIMEOUT)
+        token = client.login(username=USERNAME, password=PASSWORD, sync=False)
+    
+    with startup_timer.phase("Sync-Filter"):
+        apply_sync_filter()
+    
+    # Ohne Token einmal vollständig synchronisieren, damit alte Nachrichten nicht als neue gelten
+    with startup_timer.phase("Initialer Sync"):
+        if sync_token:
+            client.sync_token = sync_token
+        else:
+            initial_sync()
     
     # Event-Handler für Einladungen
     client.add_invite_listener(on_invite)
+    if LIGHTWEIGHT_ROOMS:
+        # Ein Listener für alle Räume statt eines Listeners pro Room-Objekt
+        client.add_listener(on_room_event, "m.room.message")
     
-    # Bekannten Räumen beitreten
-    config = load_config()
-    for room_id in config.get("joined_rooms", []):
-        try:
-            room = client.join_room(room_id)
-            rooms[room_id] = room
-            room.add_listener(on_message)
-        except Exception as e:
-            print(f"Fehler beim Beitreten zum Raum {room_id}: {str(e)}")
+    # Bekannten und zusätzlich konfigurierten Räumen beitreten
+    with startup_timer.phase("Räume"):
+        if sync_token:
+            joined_room_ids = set(client.api._send("GET", "/joined_rooms")["joined_rooms"])
+        else:
+            joined_room_ids = set(client.rooms)
+        joined = attach_rooms(config_store.joined_room_ids() + ROOMS_TO_JOIN, joined_room_ids)
+    print(f"{len(rooms)} Räume verbunden, davon {joined} neu beigetreten")
     
-    # Zusätzlichen konfigurierten Räumen beitreten
-    for room_id in ROOMS_TO_JOIN:
-        if room_id not in rooms:
-            try:
-                room = client.join_room(room_id)
-                rooms[room_id] = room
-                room.add_listener(on_message)
-                
-                # Raum zur Konfiguration hinzufügen
-                if room_id not in config["joined_rooms"]:
-                    config["joined_rooms"].append(room_id)
-                    save_config(config)
-            except Exception as e:
-                print(f"Fehler beim Beitreten zum Raum {room_id}: {str(e)}")
+    # Worker-Pool für Befehle und Versand-Threads starten
+    executor = CommandExecutor()
+    outbound_sender = OutboundSender(api=SendMatrixHttpApi(client.api))
+    
+    # Scheduler nur laden, wenn es etwas zu planen gibt; sonst beim ersten !schedule
+    with startup_timer.phase("Geplante Nachrichten"):
+        if config_store.scheduled_message_count() and feature_enabled("scheduling"):
+            load_feature("scheduling")
     
-    # Alle geplanten Nachrichten laden
-    load_all_scheduled_messages()
+    # Abgleich mit den anderen Instanzen starten
+    if shard_coordinator is not None:
+        shard_coordinator.start()
     
-    # Scheduler-Thread starten
-    thread = threading.Thread(target=scheduler_thread, daemon=True)
-    thread.start()
+    # Metrik-Endpunkt starten
+    register_gauges()
+    start_metrics_server()
     
     print(f"Bot gestartet als {client.user_id}")
+    return sync_token
+
+# Hauptfunktion
+def main():
+    if "--measure-imports" in sys.argv:
+        measure_imports()
+        return
+    
+    sync_token = start_bot()
+    install_debug_signals()
     print("Drücke Strg+C zum Beenden")
     
     # Bot starten
-    client.start_listener_thread()
+    first_sync_start = time.monotonic()
+    initial_token = client.sync_token
+    client.start_listener_thread(exception_handler=on_listener_error)
+    client.sync_thread.name = "listener"
     
-    # Haupt-Thread aktiv halten
+    # Haupt-Thread aktiv halten, Startbericht nach dem ersten Sync ausgeben
+    # und den Sync-Token regelmäßig sichern
+    saved_token = sync_token
+    last_save = time.monotonic()
+    first_sync_done = False
     try:
         while True:
             time.sleep(1)
+            if not first_sync_done and client.sync_token != initial_token:
+                first_sync_done = True
+                startup_timer.phases.append(("Erster Sync", time.monotonic() - first_sync_start))
+                print(startup_timer.report())
+            if client.sync_token != saved_token and time.monotonic() - last_save >= SYNC_STATE_SAVE_INTERVAL:
+                saved_token = client.sync_token
+                last_save = time.monotonic()
+                save_sync_token(saved_token)
     except KeyboardInterrupt:
         print("Bot wird beendet...")
+        if client.sync_token:
+            save_sync_token(client.sync_token)
+        executor.shutdown()
+        outbound_sender.flush()
+        config_store.close()
+        if shard_coordinator is not None:
+            shard_coordinator.close()
         client.logout()
 
 if __name__ == "__main__":
@@ -0,0 +1,2 @@
+# Feature-Module des Bots. Jedes Modul stellt in COMMANDS seine Befehle bereit und kann
+# eine Funktion setup() haben, die beim ersten Laden aufgerufen wird (siehe bot.load_feature).
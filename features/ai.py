@@ -0,0 +1,428 @@
+import json
+import random
+import threading
+import time
+import requests
+from collections import deque, OrderedDict
+import bot
+
+# KI-Antworten über die Messages-API (!ai und direkte Ansprache)
+
+# HTTP-Status, bei denen eine Wiederholung sinnvoll ist; 429 und 529 bedeuten Überlastung
+RETRYABLE_STATUS = {429, 500, 502, 503, 504, 529}
+OVERLOADED_STATUS = {429, 529}
+
+# Fehler bei einer KI-Anfrage; partial enthält bereits gestreamten Text.
+# status ist None bei Verbindungsfehlern und Zeitüberschreitungen.
+class AIRequestError(Exception):
+    def __init__(self, message, partial="", status=None, retryable=False, retry_after=None):
+        super().__init__(message)
+        self.partial = partial
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+# Kurzlebiger, begrenzter Cache für KI-Antworten mit Zählern für Treffer und Fehlschläge
+class AIResponseCache:
+    def __init__(self, max_entries=bot.AI_CACHE_SIZE, ttl=bot.AI_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.in_flight = bot.SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # Schlüssel aus Modell, Token-Limit und normalisiertem Prompt
+    @staticmethod
+    def make_key(model, max_tokens, prompt):
+        return (model, max_tokens, " ".join(prompt.split()))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+ai_cache = AIResponseCache()
+ai_breaker = bot.CircuitBreaker(bot.AI_BREAKER_THRESHOLD, bot.AI_BREAKER_COOLDOWN)
+
+# AIRequestError als Text für den Raum
+def describe_ai_error(error):
+    if error.partial:
+        # Bereits angezeigten Text nicht durch die Fehlermeldung ersetzen
+        return error.partial + f" [Antwort unvollständig: {str(error)}]"
+    return str(error)
+
+# KI-Antwort mit Claude von Anthropic holen, wirft AIRequestError. Gleiche Anfragen werden
+# zusammengefasst und kurz zwischengespeichert. Mit on_delta wird die Antwort gestreamt und
+# on_delta mit dem bisherigen Text aufgerufen.
+def fetch_ai_response(message, on_delta=None, max_tokens=None):
+    max_tokens = max_tokens or bot.AI_MAX_TOKENS
+    key = AIResponseCache.make_key(bot.AI_MODEL, max_tokens, message)
+    cached = ai_cache.get(key)
+    if cached is not None:
+        if on_delta is not None:
+            on_delta(cached)
+        return cached
+    
+    leader = []
+    def request():
+        leader.append(True)
+        with bot.metrics.timer("bot_ai_request_seconds", {"stream": str(on_delta is not None).lower()}):
+            text = request_ai_response(message, on_delta, max_tokens)
+        ai_cache.put(key, text)
+        return text
+    
+    text = ai_cache.in_flight.do(key, request)
+    
+    if not leader:
+        # Antwort einer gleichzeitig laufenden identischen Anfrage übernommen
+        with ai_cache.lock:
+            ai_cache.coalesced += 1
+        if on_delta is not None:
+            on_delta(text)
+    return text
+
+# Anfrage an die Messages-API, wirft AIRequestError bei Fehlern.
+# Zeitüberschreitungen, 429 und Serverfehler werden mit exponentiell wachsender Wartezeit
+# wiederholt; bei Überlastung des Hauptmodells wird AI_FALLBACK_MODEL verwendet.
+# Solange der Schutzschalter offen ist, wird die API nicht angefragt.
+def request_ai_response(message, on_delta=None, max_tokens=None):
+    headers = {
+        "x-api-key": bot.AI_API_KEY,
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json"
+    }
+    
+    data = {
+        "model": bot.AI_MODEL,
+        "max_tokens": max_tokens or bot.AI_MAX_TOKENS,
+        "messages": [
+            {
+                "role": "user",
+                "content": message
+            }
+        ]
+    }
+    
+    deadline = time.monotonic() + bot.AI_DEADLINE
+    for attempt in range(bot.AI_MAX_RETRIES + 1):
+        if not ai_breaker.allow():
+            bot.metrics.inc("bot_ai_rejected_total")
+            raise AIRequestError(f"Der KI-Dienst ist gerade nicht erreichbar. Nächster Versuch in {ai_breaker.retry_in():.0f}s.")
+        try:
+            text = send_ai_request(headers, data, on_delta)
+        except AIRequestError as e:
+            if not e.retryable:
+                # Der Dienst hat geantwortet, nur die Anfrage war fehlerhaft
+                ai_breaker.record_success()
+                raise
+            ai_breaker.record_failure()
+            if e.partial or attempt == bot.AI_MAX_RETRIES:
+                # Bereits angezeigten Text nicht durch eine zweite Antwort ersetzen
+                raise
+            delay = retry_delay(attempt, e.retry_after)
+            if e.status in OVERLOADED_STATUS and bot.AI_FALLBACK_MODEL and data["model"] != bot.AI_FALLBACK_MODEL:
+                # Das Ersatzmodell hat eigene Kapazitäten, retry-after gilt dafür nicht
+                data = dict(data, model=bot.AI_FALLBACK_MODEL)
+                delay = retry_delay(0)
+                bot.metrics.inc("bot_ai_fallbacks_total")
+            if time.monotonic() + delay > deadline:
+                raise
+            print(f"KI-Anfrage fehlgeschlagen ({str(e)}), neuer Versuch in {delay:.1f}s mit {data['model']}")
+            bot.metrics.inc("bot_ai_retries_total")
+            time.sleep(delay)
+        except Exception:
+            ai_breaker.record_failure()
+            raise
+        else:
+            ai_breaker.record_success()
+            return text
+
+# Wartezeit vor Wiederholung attempt + 1: zufällig bis zur exponentiellen Grenze,
+# mindestens aber retry-after
+def retry_delay(attempt, retry_after=None):
+    delay = random.uniform(0, min(bot.AI_RETRY_MAX_DELAY, bot.AI_RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, bot.AI_RETRY_MAX_DELAY))
+    return delay
+
+# Sekunden aus dem retry-after-Header, None wenn nicht vorhanden oder kein Zahlenwert
+def retry_after_header(response):
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+# Fehlerantwort der API in eine kurze Meldung übersetzen; der vollständige Text geht ins Log
+def api_error(response):
+    print(f"KI-API antwortete mit Status {response.status_code}: {response.text}")
+    status = response.status_code
+    if status == 429:
+        message = "Zu viele KI-Anfragen, bitte später erneut versuchen."
+    elif status in (503, 529):
+        message = "Der KI-Dienst ist überlastet, bitte später erneut versuchen."
+    elif status >= 500:
+        message = f"Der KI-Dienst hat einen Fehler gemeldet (Status {status})."
+    else:
+        try:
+            detail = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            detail = "unbekannter Fehler"
+        message = f"Fehler bei der API-Anfrage (Status {status}): {detail}"
+    return AIRequestError(message, status=status, retryable=status in RETRYABLE_STATUS,
+                          retry_after=retry_after_header(response))
+
+# Verbindungsfehler und Zeitüberschreitungen
+def connection_error(error, partial=""):
+    if isinstance(error, requests.Timeout):
+        message = "Zeitüberschreitung bei der KI-Anfrage."
+    else:
+        message = f"Fehler bei der KI-Anfrage: {str(error)}"
+    return AIRequestError(message, partial=partial, retryable=True)
+
+# Ein einzelner Versuch, mit on_delta gestreamt
+def send_ai_request(headers, data, on_delta=None):
+    if on_delta is not None:
+        return stream_ai_response(headers, data, on_delta)
+    
+    try:
+        response = bot.http_request("POST", bot.AI_API_URL, headers=headers, json=data, timeout=bot.AI_TIMEOUT)
+    except requests.RequestException as e:
+        bot.metrics.inc("bot_ai_responses_total", {"status": "error"})
+        raise connection_error(e)
+    bot.metrics.inc("bot_ai_responses_total", {"status": str(response.status_code)})
+    if response.status_code != 200:
+        raise api_error(response)
+    # Auch eine Antwort mit Status 200 kann abgeschnitten sein (kein gültiges JSON, erneut
+    # versuchen) oder einen unerwarteten Aufbau haben
+    try:
+        response_json = response.json()
+    except ValueError as e:
+        raise AIRequestError(f"Ungültige Antwort der KI-API: {str(e)}", retryable=True)
+    try:
+        return response_json.get("content", [{}])[0].get("text", "Keine Antwort erhalten.")
+    except (LookupError, TypeError, AttributeError) as e:
+        raise AIRequestError(f"Unerwartete Antwort der KI-API: {str(e)}")
+
+# Server-Sent-Events der Messages-API lesen und Textstücke weiterreichen
+def stream_ai_response(headers, data, on_delta):
+    parts = []
+    try:
+        response = bot.http_request("POST", bot.AI_API_URL, headers=headers, json=dict(data, stream=True),
+                                    stream=True, timeout=bot.AI_TIMEOUT)
+    except requests.RequestException as e:
+        bot.metrics.inc("bot_ai_responses_total", {"status": "error"})
+        raise connection_error(e)
+    bot.metrics.inc("bot_ai_responses_total", {"status": str(response.status_code)})
+    try:
+        with response:
+            if response.status_code != 200:
+                raise api_error(response)
+            
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                event = json.loads(line[5:])
+                if event.get("type") == "content_block_delta":
+                    text = event.get("delta", {}).get("text")
+                    if text:
+                        parts.append(text)
+                        on_delta("".join(parts))
+                elif event.get("type") == "error":
+                    error = event.get("error", {})
+                    overloaded = error.get("type") == "overloaded_error"
+                    raise AIRequestError(error.get("message", "Unbekannter Fehler"), partial="".join(parts),
+                                         status=529 if overloaded else None, retryable=True)
+                elif event.get("type") == "message_stop":
+                    break
+        
+        return "".join(parts) or "Keine Antwort erhalten."
+    except AIRequestError:
+        raise
+    except requests.RequestException as e:
+        raise connection_error(e, partial="".join(parts))
+    except Exception as e:
+        raise AIRequestError(f"Fehler bei der KI-Anfrage: {str(e)}", partial="".join(parts))
+
+# KI fragen und die Antwort in den Raum schreiben; liefert die Antwort oder None bei Fehlern
+def send_ai_reply(room, prompt, prefix="KI-Antwort: "):
+    if not bot.AI_STREAMING:
+        bot.send_text(room.room_id, "Frage KI... (dies kann einen Moment dauern)", status=True)
+        try:
+            ai_response = fetch_ai_response(prompt)
+        except AIRequestError as e:
+            bot.send_text(room.room_id, f"{prefix}{describe_ai_error(e)}")
+            return None
+        bot.send_text(room.room_id, f"{prefix}{ai_response}")
+        return ai_response
+    
+    reply = bot.StreamingReply(room.room_id, prefix)
+    try:
+        ai_response = fetch_ai_response(prompt, on_delta=reply.update)
+    except AIRequestError as e:
+        reply.finish(describe_ai_error(e))
+        return None
+    reply.finish(ai_response)
+    return ai_response
+
+# Grobe Token-Schätzung: etwa vier Zeichen pro Token, dazu ein Zuschlag pro Nachricht
+def estimate_tokens(text):
+    return len(text) // 4 + 4
+
+# Einfache Namensextraktion aus "@name:server"
+def sender_name(user_id):
+    return user_id.split(":")[0].lstrip("@")
+
+# Gesprächsverlauf eines Raums für !ai. Neue Nachrichten werden aus dem Raumpuffer
+# übernommen; übersteigen sie AI_CONTEXT_TOKENS, wird der ältere Teil in eine
+# Zusammenfassung gefaltet, die bis zur nächsten Faltung wiederverwendet wird.
+class ConversationContext:
+    def __init__(self, token_budget=bot.AI_CONTEXT_TOKENS):
+        self.token_budget = token_budget
+        self.lock = threading.Lock()
+        self.turns = deque()  # (Zeile, geschätzte Tokens)
+        self.tokens = 0
+        self.summary = ""
+        self.last_event_id = None
+        self.last_ts = 0
+
+    def add_turn(self, name, text):
+        line = f"{name}: {text}"
+        tokens = estimate_tokens(line)
+        with self.lock:
+            self.turns.append((line, tokens))
+            self.tokens += tokens
+
+    # Nachrichten aus dem Raumpuffer übernehmen, die seit dem letzten Aufruf dazugekommen sind
+    def sync(self, events):
+        event_ids = [event.get("event_id") for event in events]
+        if self.last_event_id in event_ids:
+            new_events = events[event_ids.index(self.last_event_id) + 1:]
+        else:
+            new_events = [event for event in events if event.get("origin_server_ts", 0) > self.last_ts]
+        for event in new_events:
+            if is_conversation_event(event):
+                self.add_turn(sender_name(event["sender"]), event["content"]["body"].strip())
+        if events:
+            self.last_event_id = events[-1].get("event_id")
+            self.last_ts = max(self.last_ts, events[-1].get("origin_server_ts", 0))
+
+    # Ältere Nachrichten zusammenfassen, bis die übrigen höchstens das halbe Budget belegen
+    def compact(self):
+        with self.lock:
+            if self.tokens <= self.token_budget:
+                return
+            folded = []
+            while self.turns and self.tokens > self.token_budget // 2:
+                line, tokens = self.turns.popleft()
+                self.tokens -= tokens
+                folded.append(line)
+            previous = self.summary
+        
+        bot.metrics.inc("bot_ai_context_summaries_total")
+        prompt = f"""Fasse das folgende Gespräch in wenigen Sätzen zusammen. Behalte Namen, Fakten, offene Fragen und Vereinbarungen.
+
+Bisherige Zusammenfassung:
+{previous or "(keine)"}
+
+Neue Nachrichten:
+""" + "\n".join(folded)
+        try:
+            summary = fetch_ai_response(prompt, max_tokens=bot.AI_SUMMARY_MAX_TOKENS)
+        except AIRequestError as e:
+            # Ohne Zusammenfassung gehen die gefalteten Nachrichten verloren, der Prompt bleibt begrenzt
+            print(f"Zusammenfassung fehlgeschlagen: {str(e)}")
+            return
+        with self.lock:
+            self.summary = summary.strip()
+
+    def build_prompt(self, name, question):
+        with self.lock:
+            history = "\n".join(line for line, tokens in self.turns)
+            summary = self.summary
+        parts = []
+        if summary:
+            parts.append(f"Zusammenfassung des bisherigen Gesprächs:\n{summary}")
+        if history:
+            parts.append(f"Letzte Nachrichten:\n{history}")
+        parts.append(f"Bitte antworte im Kontext dieser Konversation. Beziehe dich auf die letzten Nachrichten, wenn möglich.\n\nAnfrage von {name}: {question}")
+        return "\n\n".join(parts)
+
+conversations = {}
+conversations_lock = threading.Lock()
+
+# Gesprächsverlauf eines Raums holen oder anlegen
+def get_conversation(room_id):
+    with conversations_lock:
+        conversation = conversations.get(room_id)
+        if conversation is None:
+            conversation = conversations[room_id] = ConversationContext()
+        return conversation
+
+# Textnachrichten von Nutzern, ohne Befehle, Ansprachen des Bots und Bearbeitungen
+def is_conversation_event(event):
+    content = event.get("content", {})
+    if event.get("type") != "m.room.message" or content.get("msgtype") != "m.text":
+        return False
+    if event.get("sender") == bot.client.user_id or "m.new_content" in content:
+        return False
+    body = content.get("body", "").strip()
+    # Befehle und Ansprachen gehen als Anfrage in den Verlauf ein
+    return bool(body) and not body.startswith(("!", f"@{bot.USERNAME}", bot.client.user_id))
+
+# Mit dem Gesprächsverlauf des Raums antworten und Frage und Antwort anhängen
+def answer_in_context(room, sender, question):
+    conversation = get_conversation(room.room_id)
+    try:
+        conversation.sync(bot.get_recent_room_events(room, bot.RECENT_EVENTS_PER_ROOM))
+        conversation.compact()
+        prompt = conversation.build_prompt(sender_name(sender), question)
+    except Exception as e:
+        # Fallback bei Fehler: Normale KI-Anfrage ohne Kontext
+        print(f"Konversationskontext nicht verfügbar: {str(e)}")
+        send_ai_reply(room, question, prefix="KI-Antwort (ohne Konversationskontext): ")
+        return
+    
+    answer = send_ai_reply(room, prompt)
+    if answer is not None:
+        conversation.add_turn(sender_name(sender), question)
+        conversation.add_turn(sender_name(bot.client.user_id), answer)
+
+# Gesprächsverlauf eines inaktiven Raums freigeben (siehe bot.evict_idle_rooms);
+# er wird beim nächsten !ai aus dem Raumverlauf neu aufgebaut
+def evict_room(room_id):
+    with conversations_lock:
+        conversations.pop(room_id, None)
+
+# !ai: KI mit dem Verlauf des Raums als Kontext fragen
+def handle_ai_command(room, sender, args):
+    answer_in_context(room, sender, args)
+
+# Messwerte des Features registrieren (beim ersten Laden)
+def setup():
+    bot.metrics.gauge("bot_ai_cache_hits", lambda: ai_cache.hits)
+    bot.metrics.gauge("bot_ai_cache_misses", lambda: ai_cache.misses)
+    bot.metrics.gauge("bot_ai_cache_coalesced", lambda: ai_cache.coalesced)
+    bot.metrics.gauge("bot_ai_conversations", lambda: len(conversations))
+    bot.metrics.gauge("bot_ai_breaker_open", lambda: int(ai_breaker.state != ai_breaker.CLOSED))
+    bot.metrics.gauge("bot_ai_breaker_trips", lambda: ai_breaker.trips)
+
+COMMANDS = {
+    "!ai": handle_ai_command,
+}
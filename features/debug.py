@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+import bot
+
+# Diagnose laufender Instanzen (!debug, SIGUSR1/SIGUSR2): CPU-Profil per Stichproben
+# über alle Threads und Speicher-Schnappschüsse mit tracemalloc. Nur für ADMIN_USERS.
+
+profile_lock = threading.Lock()
+memory_lock = threading.Lock()
+last_snapshot = None
+
+# Oberste Frames, in denen ein Thread nur wartet (Bedingungen, Warteschlangen, select)
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("selectors.py", "select"),
+    ("socketserver.py", "serve_forever"),
+}
+
+# Dateiname für ein Profil in PROFILE_DIR
+def profile_path(kind, extension):
+    os.makedirs(bot.PROFILE_DIR, exist_ok=True)
+    return os.path.join(bot.PROFILE_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.{extension}")
+
+# Thread-Gruppe aus dem Namen: "command_3" -> "command", "Thread-7 (run)" -> "Thread"
+def thread_group(name):
+    return re.sub(r"[_-]\d+.*$", "", name)
+
+# Stichproben-Profiler: liest in festen Abständen die Stacks aller Threads über
+# sys._current_frames und zählt gleiche Stacks. Misst Wandzeit, also auch Warten auf Netz und Locks.
+class SamplingProfiler:
+    def __init__(self, interval=bot.DEBUG_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()  # (Thread-Gruppe, Funktionen von außen nach innen, wartet) -> Stichproben
+        self.samples = 0
+
+    def sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            idle = (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[(thread_group(names.get(ident, str(ident))), tuple(stack), idle)] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+
+    # Aktive und wartende Stichproben pro Thread-Gruppe
+    def thread_groups(self):
+        groups = {}
+        for (group, stack, idle), count in self.stacks.items():
+            active, total = groups.get(group, (0, 0))
+            groups[group] = (active + (0 if idle else count), total + count)
+        return groups
+
+    # Häufigste Funktionen ohne wartende Threads: selbst (oberster Frame) und inklusive Aufrufe
+    def top_functions(self, limit):
+        own = Counter()
+        inclusive = Counter()
+        for (group, stack, idle), count in self.stacks.items():
+            if idle or not stack:
+                continue
+            own[stack[-1]] += count
+            for function in set(stack):
+                # Thread-Einstiegspunkte stehen in jedem Stack und sagen nichts aus
+                if "(threading.py:" not in function:
+                    inclusive[function] += count
+        return own.most_common(limit), inclusive.most_common(limit)
+
+    # Gefaltete Stacks für flamegraph.pl oder speedscope: "Gruppe;außen;...;innen Anzahl"
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for (group, stack, idle), count in sorted(self.stacks.items()):
+                f.write(";".join((group,) + stack) + f" {count}\n")
+
+# CPU-Profil über seconds Sekunden aufnehmen und als Text zusammenfassen
+def cpu_profile(seconds):
+    if not profile_lock.acquire(blocking=False):
+        return "Es läuft bereits ein CPU-Profil."
+    try:
+        profiler = SamplingProfiler()
+        profiler.run(seconds)
+        path = profile_path("cpu", "collapsed")
+        profiler.write_collapsed(path)
+    finally:
+        profile_lock.release()
+
+    groups = profiler.thread_groups()
+    active_samples = sum(active for active, total in groups.values()) or 1
+    own, inclusive = profiler.top_functions(bot.DEBUG_REPORT_LINES)
+    lines = [f"CPU-Profil über {seconds}s ({profiler.samples} Stichproben, alle {profiler.interval * 1000:.0f}ms)",
+             "Threads (aktiv / gesamt): " + ", ".join(
+                 f"{group} {active}/{total}" for group, (active, total) in sorted(groups.items(), key=lambda item: -item[1][0]))]
+    lines.append("Selbst:")
+    lines.extend(f"{100 * count / active_samples:5.1f}% {function}" for function, count in own)
+    lines.append("Inklusive:")
+    lines.extend(f"{100 * count / active_samples:5.1f}% {function}" for function, count in inclusive)
+    lines.append(f"Gespeichert: {path}")
+    return "\n".join(lines)
+
+# Größen der Sammlungen, die mit der Laufzeit oder der Zahl der Räume wachsen
+def tracked_collections():
+    sizes = [
+        ("rooms", len(bot.rooms)),
+        ("processed_events", len(bot.processed_events)),
+        ("recent_events", sum(len(buffer.events) for buffer in list(bot.recent_events.values()))),
+    ]
+    if bot.client is not None:
+        client_rooms = list(bot.client.rooms.values())
+        sizes.append(("client.rooms", len(client_rooms)))
+        # Mit LIGHTWEIGHT_ROOMS sind es RoomHandles ohne Events und Mitglieder
+        sizes.append(("Room.events", sum(len(getattr(room, "events", ())) for room in client_rooms)))
+        sizes.append(("Room._members", sum(len(getattr(room, "_members", ())) for room in client_rooms)))
+    ai = bot.features.get("ai")
+    if ai is not None:
+        sizes.append(("ai_cache", len(ai.ai_cache.entries)))
+        sizes.append(("conversations", len(ai.conversations)))
+    transcription = bot.features.get("transcription")
+    if transcription is not None:
+        sizes.append(("transcription_cache", len(transcription.transcription_cache.texts)))
+    scheduling = bot.features.get("scheduling")
+    if scheduling is not None:
+        sizes.append(("scheduler", len(scheduling.message_scheduler)))
+        sizes.append(("broadcast_results", len(scheduling.broadcast_results)))
+    return sizes
+
+# Speicher-Schnappschuss: beim ersten Aufruf tracemalloc starten, danach Zuwachs seit dem
+# letzten Schnappschuss nach Codezeile. Schnappschüsse werden in PROFILE_DIR gespeichert
+# und lassen sich mit tracemalloc.Snapshot.load auswerten.
+def memory_snapshot():
+    global last_snapshot
+    with memory_lock:
+        sizes = ", ".join(f"{name} {size}" for name, size in tracked_collections())
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(bot.DEBUG_TRACEMALLOC_FRAMES)
+            last_snapshot = tracemalloc.take_snapshot()
+            return f"tracemalloc gestartet. Erneut aufrufen, um den Zuwachs zu sehen.\nSammlungen: {sizes}"
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        path = profile_path("mem", "tracemalloc")
+        snapshot.dump(path)
+        stats = snapshot.compare_to(last_snapshot, "lineno")[:bot.DEBUG_REPORT_LINES]
+        last_snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+
+    lines = [f"Speicher: {current / 1024 / 1024:.1f}MB verfolgt, Spitze {peak / 1024 / 1024:.1f}MB",
+             f"Sammlungen: {sizes}",
+             "Zuwachs seit dem letzten Schnappschuss:"]
+    for stat in stats:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size_diff / 1024:+8.1f}KB {stat.count_diff:+6d} Obj. {os.path.basename(frame.filename)}:{frame.lineno}")
+    lines.append(f"Gespeichert: {path}")
+    return "\n".join(lines)
+
+# tracemalloc beenden und den letzten Schnappschuss verwerfen
+def stop_memory_tracing():
+    global last_snapshot
+    with memory_lock:
+        tracemalloc.stop()
+        last_snapshot = None
+
+# Für die Signal-Handler in bot.py: SIGUSR1 = CPU-Profil, SIGUSR2 = Speicher-Schnappschuss
+def run_report(action):
+    if action == "profile":
+        return cpu_profile(bot.DEBUG_PROFILE_SECONDS)
+    return memory_snapshot()
+
+# !debug profile [Sekunden] | mem [stop]
+def handle_debug_command(room, sender, args):
+    if not bot.is_admin(sender):
+        bot.send_text(room.room_id, "!debug ist Admins vorbehalten.")
+        return
+
+    parts = args.split()
+    subcmd = parts[0].lower() if parts else ""
+    if subcmd == "profile":
+        try:
+            seconds = float(parts[1]) if len(parts) > 1 else bot.DEBUG_PROFILE_SECONDS
+        except ValueError:
+            bot.send_text(room.room_id, "Bitte gib die Dauer in Sekunden an.")
+            return
+        seconds = min(max(seconds, 1), bot.DEBUG_PROFILE_MAX_SECONDS)
+        bot.send_text(room.room_id, f"Nehme CPU-Profil über {seconds:g}s auf...", status=True)
+        # Eigener Thread, damit der Befehls-Worker und der Raum nicht blockiert sind
+        threading.Thread(target=lambda: bot.send_text(room.room_id, cpu_profile(seconds)),
+                         name="debug", daemon=True).start()
+    elif subcmd == "mem":
+        if len(parts) > 1 and parts[1].lower() == "stop":
+            stop_memory_tracing()
+            bot.send_text(room.room_id, "tracemalloc beendet.")
+        else:
+            bot.send_text(room.room_id, memory_snapshot())
+    else:
+        bot.send_text(room.room_id, "Verwendung: !debug profile [Sekunden] | !debug mem [stop]")
+
+COMMANDS = {
+    "!debug": handle_debug_command,
+}
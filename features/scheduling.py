@@ -0,0 +1,646 @@
+import time
+import datetime
+import threading
+import heapq
+import itertools
+import traceback
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pytz
+from matrix_client.errors import MatrixRequestError, MatrixHttpLibError
+import bot
+
+# Geplante Nachrichten (!schedule) mit eigenem Scheduler-Thread
+
+message_scheduler = None
+takeover_scheduler = None
+broadcast_executor = None
+broadcast_results = OrderedDict()  # Nachrichten-ID -> letzte BroadcastRun
+broadcast_results_lock = threading.Lock()
+
+# Zeitzone auflösen: Nachricht, dann Raum, dann DEFAULT_TIMEZONE (None = Serverzeit)
+def message_timezone(message_data):
+    name = message_data.get("timezone") or get_room_timezone(message_data["room_id"])
+    return pytz.timezone(name) if name else None
+
+def get_room_timezone(room_id):
+    return bot.config_store.get_room_setting(room_id, "timezone") or bot.DEFAULT_TIMEZONE
+
+# Lokale Uhrzeit in einer Zeitzone in einen Unix-Zeitstempel umrechnen
+def local_to_timestamp(naive_datetime, tz):
+    if tz is None:
+        return time.mktime(naive_datetime.timetuple())
+    return tz.normalize(tz.localize(naive_datetime)).timestamp()
+
+# Nächster Termin einer Nachricht nach dem Zeitpunkt after (Unix-Zeit)
+def next_occurrence(message_data, after):
+    tz = message_timezone(message_data)
+    hour, minute = map(int, message_data["schedule_time"].split(":"))
+    repeat = message_data["repeat"]
+    start_date = datetime.datetime.fromtimestamp(after, tz).date()
+    
+    for offset in range(9):
+        day = start_date + datetime.timedelta(days=offset)
+        if repeat == "weekdays" and day.weekday() >= 5:
+            continue
+        if repeat == "weekly" and day.weekday() != message_data["weekday"]:
+            continue
+        timestamp = local_to_timestamp(datetime.datetime.combine(day, datetime.time(hour, minute)), tz)
+        if timestamp > after:
+            return timestamp
+    raise ValueError(f"Kein Termin für Nachricht {message_data['id']} gefunden")
+
+# Scheduler mit Prioritätswarteschlange: schläft genau bis zum nächsten fälligen Termin.
+# Entfernte oder verschobene Einträge bleiben im Heap und werden beim Erreichen verworfen.
+class MessageScheduler:
+    def __init__(self, on_due):
+        self.on_due = on_due
+        self.cond = threading.Condition()
+        self.heap = []
+        self.entries = {}  # message_id -> (Sequenznummer, Termin) des gültigen Heap-Eintrags
+        self.counter = itertools.count()
+
+    def schedule(self, message_id, due):
+        with self.cond:
+            seq = next(self.counter)
+            self.entries[message_id] = (seq, due)
+            heapq.heappush(self.heap, (due, seq, message_id))
+            if self.heap[0][1] == seq:
+                # Neuer frühester Termin, wartenden Thread wecken
+                self.cond.notify()
+            self._compact()
+
+    def cancel(self, message_id):
+        with self.cond:
+            self.entries.pop(message_id, None)
+            self._compact()
+
+    def next_due(self, message_id):
+        with self.cond:
+            entry = self.entries.get(message_id)
+            return entry[1] if entry else None
+
+    def __len__(self):
+        with self.cond:
+            return len(self.entries)
+
+    def _is_stale(self, item):
+        entry = self.entries.get(item[2])
+        return entry is None or entry[0] != item[1]
+
+    def _compact(self):
+        # Heap neu aufbauen, wenn er überwiegend aus verworfenen Einträgen besteht
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.entries):
+            self.heap = [item for item in self.heap if not self._is_stale(item)]
+            heapq.heapify(self.heap)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    while self.heap and self._is_stale(self.heap[0]):
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    # Höchstens eine Minute am Stück warten, falls die Systemuhr springt
+                    self.cond.wait(min(delay, 60))
+                due, seq, message_id = heapq.heappop(self.heap)
+                del self.entries[message_id]
+            try:
+                self.on_due(message_id, due)
+            except Exception:
+                traceback.print_exc()
+
+# Fälligen Termin verarbeiten: Folgetermin planen und Versand an den Worker-Pool geben
+def on_scheduled_message_due(message_id, due):
+    message_data = bot.config_store.get_scheduled_message(message_id)
+    if message_data is None:
+        return
+    
+    if message_data["repeat"]:
+        message_scheduler.schedule(message_id, next_occurrence(message_data, max(due, time.time())))
+    
+    if bot.shard_coordinator is not None and not bot.shard_coordinator.owns_room(message_data["room_id"]):
+        # Zuständig ist eine andere Instanz; ist sie bis nach Ablauf ihres Leases ausgefallen,
+        # versendet der neue Zuständige den Termin
+        takeover_scheduler.schedule(
+            (message_id, due), max(due, time.time()) + bot.SHARD_LEASE_TIMEOUT + bot.SHARD_HEARTBEAT_INTERVAL)
+        return
+    
+    if not bot.executor.submit(message_data["room_id"], send_scheduled_message, message_data, due):
+        print(f"Geplante Nachricht {message_id} verworfen: zu viele wartende Aufgaben im Raum")
+
+# Termin einer anderen Instanz prüfen: wurde er nicht versendet, jetzt selbst versenden
+def on_takeover_due(key, check_time):
+    message_id, due = key
+    message_data = bot.config_store.get_scheduled_message(message_id)
+    if message_data is None or not bot.shard_coordinator.owns_room(message_data["room_id"]):
+        return
+    # Ob der Termin schon versendet wurde, entscheidet der Anspruch in send_scheduled_message
+    bot.executor.submit(message_data["room_id"], send_scheduled_message, message_data, due)
+
+# Änderungen der anderen Instanzen im Scheduler nachziehen
+def apply_changes(changed, removed, settings):
+    for message_id in removed:
+        message_scheduler.cancel(message_id)
+    if "timezone" in settings:
+        # Geänderte Raum-Zeitzonen betreffen alle Nachrichten ohne eigene Zeitzone
+        changed = bot.config_store.scheduled_messages()
+    for message_data in changed:
+        try:
+            schedule_message(message_data)
+        except Exception as e:
+            print(f"Fehler beim Planen der Nachricht {message_data.get('id')}: {str(e)}")
+
+# Geplante Nachricht hinzufügen. Rundsendungen haben zusätzlich "targets" (Raum-IDs)
+# oder "tag"; room_id ist dann der Raum, in dem sie angelegt wurden.
+def add_scheduled_message(room_id, message, schedule_time, repeat=None, timezone=None, targets=None, tag=None):
+    new_message = {
+        "room_id": room_id,
+        "message": message,
+        "schedule_time": schedule_time,
+        "repeat": repeat
+    }
+    if timezone:
+        new_message["timezone"] = timezone
+    if targets:
+        new_message["targets"] = list(targets)
+    if tag:
+        new_message["tag"] = tag
+    
+    now = time.time()
+    if repeat:
+        # Termine ab jetzt gelten als erledigt (Grundlage für das Nachholen nach Neustarts)
+        new_message["last_run"] = now
+    if repeat == "weekly":
+        first = next_occurrence(dict(new_message, id=None, repeat=None), now)
+        new_message["weekday"] = datetime.datetime.fromtimestamp(first, message_timezone(new_message)).weekday()
+    if not repeat:
+        new_message["due_at"] = next_occurrence(dict(new_message, id=None), now)
+    
+    message_id = bot.config_store.add_scheduled_message(new_message)
+    schedule_message(new_message)
+    return message_id
+
+# Nachricht senden
+def send_scheduled_message(message_data, due=None):
+    room_id = message_data["room_id"]
+    message = message_data["message"]
+    
+    # Mit mehreren Instanzen versendet nur, wer den Termin beansprucht hat
+    claimed = bot.shard_coordinator is not None and due is not None
+    if claimed and not bot.shard_coordinator.claim_delivery(message_data["id"], due):
+        return
+    
+    if is_broadcast(message_data):
+        start_broadcast(message_data, due, claimed)
+        return
+    
+    if bot.get_room(room_id) is None:
+        try:
+            bot.register_room(bot.client.join_room(room_id))
+        except Exception as e:
+            print(f"Konnte Raum nicht beitreten: {str(e)}")
+            if claimed:
+                bot.shard_coordinator.release_delivery(message_data["id"], due)
+            return
+    
+    sent = bot.send_text(room_id, f"[Geplante Nachricht] {message}")
+    if claimed:
+        # Erst nach dem Versandversuch als erledigt markieren; stirbt die Instanz vorher,
+        # übernimmt eine andere den Termin
+        with contextlib.suppress(Exception):
+            sent.wait()
+    if due is not None:
+        bot.metrics.observe("bot_scheduler_drift_seconds", max(0.0, time.time() - due))
+    finish_scheduled_message(message_data, due, claimed)
+
+# Termin abschließen: Anspruch als versendet markieren, Folgetermin merken oder Nachricht entfernen
+def finish_scheduled_message(message_data, due, claimed):
+    if claimed:
+        bot.shard_coordinator.finish_delivery(message_data["id"], due)
+    if message_data["repeat"]:
+        bot.config_store.update_scheduled_message(message_data["id"], last_run=due or time.time())
+    else:
+        # Einmalige Nachrichten nach dem Versand entfernen
+        bot.config_store.remove_scheduled_message(message_data["id"])
+
+def is_broadcast(message_data):
+    return "targets" in message_data or "tag" in message_data
+
+# Zielräume einer Rundsendung ohne abbestellte Räume; Tags werden erst beim Versand aufgelöst
+def broadcast_targets(message_data):
+    if "tag" in message_data:
+        room_ids = [room_id for room_id, tags in bot.config_store.room_setting_values("tags").items()
+                    if message_data["tag"] in tags]
+    else:
+        room_ids = message_data["targets"]
+    excluded = set(message_data.get("excluded", ()))
+    return [room_id for room_id in room_ids if room_id not in excluded]
+
+# Rundsendungen anderer Räume, die diesen Raum erreichen
+def incoming_broadcasts(room_id):
+    return [message_data for message_data in bot.config_store.scheduled_messages()
+            if is_broadcast(message_data) and message_data["room_id"] != room_id
+            and room_id in broadcast_targets(message_data)]
+
+# Darf der Benutzer Rundsendungen für diesen Raum verwalten (Tags, Abbestellen)?
+# Admins immer, sonst ab BROADCAST_MANAGE_POWER_LEVEL im Raum
+def can_manage_broadcasts(room_id, user_id):
+    if bot.is_admin(user_id):
+        return True
+    try:
+        power_levels = bot.client.api.get_power_levels(room_id)
+    except (MatrixRequestError, MatrixHttpLibError) as e:
+        print(f"Power-Levels für Raum {room_id} konnten nicht geladen werden: {str(e)}")
+        return False
+    level = power_levels.get("users", {}).get(user_id, power_levels.get("users_default", 0))
+    return level >= bot.BROADCAST_MANAGE_POWER_LEVEL
+
+# Ein Termin einer Rundsendung mit Ergebnis pro Raum
+class BroadcastRun:
+    def __init__(self, message_id, room_id, due, room_ids):
+        self.message_id = message_id
+        self.room_id = room_id
+        self.due = due
+        self.room_ids = room_ids
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration = None
+        self.results = {}  # Raum-ID -> None (gesendet) oder Fehlermeldung
+        self.remaining = len(room_ids)
+        self.lock = threading.Lock()
+
+    # Ergebnis eintragen; True für das letzte ausstehende Ergebnis
+    def record(self, room_id, error=None):
+        with self.lock:
+            self.results[room_id] = error
+            self.remaining -= 1
+            if self.remaining > 0:
+                return False
+            self.duration = time.monotonic() - self.started
+            return True
+
+    def summary(self):
+        with self.lock:
+            failed = sum(1 for error in self.results.values() if error is not None)
+            sent = len(self.results) - failed
+            remaining, duration = self.remaining, self.duration
+        text = f"{sent}/{len(self.room_ids)} Räume erreicht"
+        if failed:
+            text += f", {failed} fehlgeschlagen"
+        if remaining:
+            return text + f", {remaining} ausstehend"
+        return text + f" in {duration:.1f}s"
+
+# Rundsendung an den Versand-Pool geben; höchstens BROADCAST_PARALLELISM Räume gleichzeitig.
+# Der aufrufende Befehls-Worker wartet nicht auf die Zustellung.
+def start_broadcast(message_data, due, claimed):
+    room_ids = list(dict.fromkeys(broadcast_targets(message_data)))
+    if claimed:
+        done = bot.shard_coordinator.broadcast_sent_rooms(message_data["id"], due)
+        room_ids = [room_id for room_id in room_ids if room_id not in done]
+    if due is not None:
+        bot.metrics.observe("bot_scheduler_drift_seconds", max(0.0, time.time() - due))
+    
+    run = BroadcastRun(message_data["id"], message_data["room_id"], due, room_ids)
+    with broadcast_results_lock:
+        broadcast_results[message_data["id"]] = run
+        broadcast_results.move_to_end(message_data["id"])
+        while len(broadcast_results) > bot.BROADCAST_RESULTS_KEEP:
+            broadcast_results.popitem(last=False)
+    
+    if not room_ids:
+        run.duration = 0.0
+        finish_scheduled_message(message_data, due, claimed)
+        return
+    text = f"[Geplante Nachricht] {message_data['message']}"
+    for room_id in room_ids:
+        broadcast_executor.submit(deliver_broadcast, run, message_data, room_id, text, claimed)
+
+# Rundsendung in einen Raum zustellen und das Ergebnis eintragen
+def deliver_broadcast(run, message_data, room_id, text, claimed):
+    error = None
+    try:
+        if bot.get_room(room_id) is None:
+            bot.register_room(bot.client.join_room(room_id))
+        message = bot.send_text(room_id, text)
+        event_id = message.wait(bot.BROADCAST_SEND_TIMEOUT)
+        if event_id is None:
+            if bot.outbound_sender.cancel(message):
+                # Nicht mehr senden, sonst wäre das Ergebnis falsch und nach einer Übernahme
+                # durch eine andere Instanz käme die Nachricht doppelt an
+                error = "Zeitüberschreitung, nicht gesendet"
+            else:
+                # Die Zustellung läuft bereits und ist durch SEND_MAX_RETRIES begrenzt:
+                # auf das tatsächliche Ergebnis warten
+                event_id = message.wait()
+        if event_id is not None and claimed:
+            bot.shard_coordinator.mark_broadcast_room(run.message_id, run.due, room_id)
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    bot.metrics.inc("bot_broadcast_deliveries_total", {"result": "failed" if error else "sent"})
+    
+    if run.record(room_id, error):
+        bot.metrics.observe("bot_broadcast_seconds", run.duration)
+        print(f"Rundsendung {run.message_id}: {run.summary()}")
+        finish_scheduled_message(message_data, run.due, claimed)
+
+# Nachricht planen; verpasste Termine innerhalb von SCHEDULER_CATCHUP_WINDOW werden sofort nachgeholt
+def schedule_message(message_data):
+    now = time.time()
+    message_id = message_data["id"]
+    
+    if not message_data["repeat"]:
+        due = message_data.get("due_at")
+        if due is None:
+            # Ältere Einträge ohne Termin: nächstes Auftreten der Uhrzeit
+            due = next_occurrence(message_data, now)
+            bot.config_store.update_scheduled_message(message_id, due_at=due)
+        elif due < now - bot.SCHEDULER_CATCHUP_WINDOW:
+            print(f"Geplante Nachricht {message_id} zu lange verpasst, wird entfernt")
+            bot.config_store.remove_scheduled_message(message_id)
+            return
+        message_scheduler.schedule(message_id, due)
+        return
+    
+    if message_data["repeat"] == "weekly" and "weekday" not in message_data:
+        # Ältere wöchentliche Einträge auf den nächsten passenden Tag festlegen
+        first = next_occurrence(dict(message_data, repeat="daily"), now)
+        bot.config_store.update_scheduled_message(
+            message_id, weekday=datetime.datetime.fromtimestamp(first, message_timezone(message_data)).weekday())
+    
+    last_run = message_data.get("last_run")
+    if last_run is not None:
+        missed = next_occurrence(message_data, last_run)
+        if now - bot.SCHEDULER_CATCHUP_WINDOW <= missed <= now:
+            message_scheduler.schedule(message_id, missed)
+            return
+    message_scheduler.schedule(message_id, next_occurrence(message_data, now))
+
+# Uhrzeit mit optionaler Zeitzone ("HH:MM" oder "HH:MM@Europe/Berlin") prüfen
+def parse_schedule_time(time_str):
+    time_part, _, timezone = time_str.partition("@")
+    hour, minute = map(int, time_part.split(":"))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError()
+    if timezone:
+        pytz.timezone(timezone)
+    return f"{hour:02d}:{minute:02d}", timezone or None
+
+# Geplante Nachricht für !schedule list formatieren
+def format_scheduled_message(message_data):
+    tz = message_timezone(message_data)
+    due = message_scheduler.next_due(message_data["id"])
+    when = datetime.datetime.fromtimestamp(due, tz).strftime("%d.%m. %H:%M") if due else message_data["schedule_time"]
+    repeat = message_data["repeat"] or "einmalig"
+    target = ""
+    if "tag" in message_data:
+        target = f" an tag:{message_data['tag']}"
+    elif "targets" in message_data:
+        target = f" an {len(message_data['targets'])} Räume"
+    return f"ID {message_data['id']}: {when} ({repeat}, {tz.zone if tz else 'Serverzeit'}){target} - {message_data['message'][:30]}..."
+
+# Ziel einer Rundsendung auflösen: "tag:Name" oder kommagetrennte Raum-IDs und -Aliase.
+# Liefert (targets, tag).
+def parse_broadcast_target(target):
+    if target.startswith("tag:"):
+        tag = target[4:]
+        if not tag:
+            raise ValueError("Bitte gib einen Tag-Namen an.")
+        return None, tag
+    targets = []
+    for room in filter(None, target.split(",")):
+        targets.append(bot.client.api.get_room_id(room) if room.startswith("#") else room)
+    if not targets:
+        raise ValueError("Bitte gib mindestens einen Raum an.")
+    return targets, None
+
+# Ergebnis der letzten Rundsendung für !schedule results formatieren
+def format_broadcast_results(run):
+    when = datetime.datetime.fromtimestamp(run.started_at).strftime("%d.%m. %H:%M")
+    with run.lock:
+        failed = [(room_id, error) for room_id, error in run.results.items() if error is not None]
+    lines = [f"Rundsendung {run.message_id} vom {when}: {run.summary()}"]
+    lines.extend(f"{room_id}: {error}" for room_id, error in failed[:20])
+    if len(failed) > 20:
+        lines.append(f"... und {len(failed) - 20} weitere")
+    return "\n".join(lines)
+
+# Alle geplanten Nachrichten laden und planen
+def load_all_scheduled_messages():
+    for message_data in bot.config_store.scheduled_messages():
+        try:
+            schedule_message(message_data)
+        except Exception as e:
+            print(f"Fehler beim Planen der Nachricht {message_data.get('id')}: {str(e)}")
+
+# !schedule: geplante Nachrichten anlegen, anzeigen und entfernen
+def handle_schedule_command(room, sender, args):
+    if not args:
+        bot.send_text(room.room_id, "Bitte gib einen Unterbefehl an. !help für Hilfe.")
+        return
+    
+    schedule_parts = args.split(" ", 1)
+    subcmd = schedule_parts[0].lower()
+    subargs = schedule_parts[1] if len(schedule_parts) > 1 else ""
+    
+    if subcmd == "list":
+        room_messages = bot.config_store.room_scheduled_messages(room.room_id)
+        if room_messages:
+            message_list = "\n".join([format_scheduled_message(m) for m in room_messages])
+            bot.send_text(room.room_id, f"Geplante Nachrichten:\n{message_list}")
+        else:
+            bot.send_text(room.room_id, "Keine geplanten Nachrichten für diesen Raum.")
+        return
+    
+    elif subcmd == "incoming":
+        incoming = incoming_broadcasts(room.room_id)
+        if incoming:
+            message_list = "\n".join([format_scheduled_message(m) for m in incoming])
+            bot.send_text(room.room_id, f"Rundsendungen an diesen Raum (abbestellen mit !schedule remove [ID]):\n{message_list}")
+        else:
+            bot.send_text(room.room_id, "Keine Rundsendungen an diesen Raum.")
+        return
+    
+    elif subcmd == "remove":
+        try:
+            msg_id = int(subargs)
+            
+            # Prüfen, ob Nachricht existiert
+            message = bot.config_store.get_scheduled_message(msg_id)
+            if not message:
+                bot.send_text(room.room_id, f"Keine Nachricht mit ID {msg_id} gefunden.")
+                return
+            
+            # Rundsendung aus einem anderen Raum: nur für diesen Raum abbestellen
+            if message["room_id"] != room.room_id and is_broadcast(message) and room.room_id in broadcast_targets(message):
+                if not can_manage_broadcasts(room.room_id, sender):
+                    bot.send_text(room.room_id, "Nur Moderatoren dieses Raums können Rundsendungen abbestellen.")
+                    return
+                excluded = list(message.get("excluded", [])) + [room.room_id]
+                bot.config_store.update_scheduled_message(msg_id, excluded=excluded)
+                bot.send_text(room.room_id, f"Rundsendung {msg_id} wird nicht mehr in diesen Raum gesendet.")
+                return
+            
+            # Prüfen, ob Benutzer berechtigt ist (nur im gleichen Raum)
+            if message["room_id"] != room.room_id:
+                bot.send_text(room.room_id, "Du kannst nur Nachrichten aus diesem Raum entfernen.")
+                return
+            if is_broadcast(message) and not can_manage_broadcasts(room.room_id, sender):
+                bot.send_text(room.room_id, "Nur Moderatoren dieses Raums können Rundsendungen entfernen.")
+                return
+            
+            # Nachricht und Termin entfernen
+            bot.config_store.remove_scheduled_message(msg_id)
+            message_scheduler.cancel(msg_id)
+            
+            bot.send_text(room.room_id, f"Nachricht mit ID {msg_id} entfernt.")
+        except ValueError:
+            bot.send_text(room.room_id, "Bitte gib eine gültige ID an.")
+        except Exception as e:
+            bot.send_text(room.room_id, f"Fehler: {str(e)}")
+        return
+    
+    elif subcmd in ["add", "daily", "weekly", "weekdays", "broadcast"]:
+        repeat = None if subcmd == "add" else subcmd
+        targets = tag = None
+        
+        try:
+            if subcmd == "broadcast":
+                # !schedule broadcast <Ziel> <add|daily|weekly|weekdays> HH:MM <Nachricht>
+                broadcast_parts = subargs.split(" ", 2)
+                if len(broadcast_parts) != 3 or broadcast_parts[1].lower() not in ["add", "daily", "weekly", "weekdays"]:
+                    bot.send_text(room.room_id, "Format: !schedule broadcast [tag:Name|Raum1,Raum2] [add|daily|weekly|weekdays] HH:MM [Nachricht]")
+                    return
+                repeat = None if broadcast_parts[1].lower() == "add" else broadcast_parts[1].lower()
+                try:
+                    targets, tag = parse_broadcast_target(broadcast_parts[0])
+                except Exception as e:
+                    bot.send_text(room.room_id, f"Ungültiges Ziel: {str(e)}")
+                    return
+                if targets and not bot.is_admin(sender):
+                    # Tags werden in den Räumen selbst gesetzt, beliebige Raumlisten nur von Admins
+                    bot.send_text(room.room_id, "Rundsendungen an Raumlisten sind Admins vorbehalten. Verwende tag:Name.")
+                    return
+                if tag and not can_manage_broadcasts(room.room_id, sender):
+                    # Eine Rundsendung erreicht alle Räume mit dem Tag, nicht nur diesen
+                    bot.send_text(room.room_id, "Nur Moderatoren dieses Raums können Rundsendungen planen.")
+                    return
+                subargs = broadcast_parts[2]
+            
+            time_parts = subargs.split(" ", 1)
+            if len(time_parts) != 2:
+                bot.send_text(room.room_id, "Bitte gib Zeit und Nachricht an.")
+                return
+            
+            msg_text = time_parts[1]
+            
+            # Zeit validieren
+            try:
+                time_str, timezone = parse_schedule_time(time_parts[0])
+            except pytz.UnknownTimeZoneError as e:
+                bot.send_text(room.room_id, f"Unbekannte Zeitzone: {str(e)}")
+                return
+            except:
+                bot.send_text(room.room_id, "Bitte gib die Zeit im Format HH:MM an.")
+                return
+            
+            # Nachricht planen
+            msg_id = add_scheduled_message(room.room_id, msg_text, time_str, repeat, timezone, targets, tag)
+            
+            if targets or tag:
+                target = f"tag:{tag}" if tag else f"{len(targets)} Räume"
+                bot.send_text(room.room_id, f"Rundsendung an {target} für {time_str} geplant ({repeat or 'einmalig'}). ID: {msg_id}")
+            elif repeat:
+                bot.send_text(room.room_id, f"{repeat.capitalize()} Nachricht für {time_str} geplant. ID: {msg_id}")
+            else:
+                bot.send_text(room.room_id, f"Einmalige Nachricht für {time_str} geplant. ID: {msg_id}")
+            
+        except Exception as e:
+            bot.send_text(room.room_id, f"Fehler: {str(e)}")
+        return
+    
+    elif subcmd == "timezone":
+        if not subargs:
+            bot.send_text(room.room_id, f"Zeitzone dieses Raums: {get_room_timezone(room.room_id) or 'Serverzeit'}")
+            return
+        
+        try:
+            timezone = str(pytz.timezone(subargs.strip()))
+        except pytz.UnknownTimeZoneError:
+            bot.send_text(room.room_id, f"Unbekannte Zeitzone: {subargs.strip()}")
+            return
+        
+        bot.config_store.set_room_setting(room.room_id, "timezone", timezone)
+        
+        # Nachrichten ohne eigene Zeitzone neu planen
+        for message_data in bot.config_store.room_scheduled_messages(room.room_id):
+            if not message_data.get("timezone") and message_data["repeat"]:
+                message_scheduler.schedule(message_data["id"], next_occurrence(message_data, time.time()))
+        
+        bot.send_text(room.room_id, f"Zeitzone dieses Raums auf {timezone} gesetzt.")
+        return
+    
+    elif subcmd in ["tag", "untag"]:
+        tag = subargs.strip()
+        tags = list(bot.config_store.get_room_setting(room.room_id, "tags", []))
+        if not tag:
+            bot.send_text(room.room_id, f"Tags dieses Raums: {', '.join(sorted(tags)) or 'keine'}")
+            return
+        
+        # Wer den Raum in einen Tag aufnimmt, erlaubt Rundsendungen aus anderen Räumen hierher
+        if not can_manage_broadcasts(room.room_id, sender):
+            bot.send_text(room.room_id, "Nur Moderatoren dieses Raums können Tags setzen oder entfernen.")
+            return
+        
+        if subcmd == "tag" and tag not in tags:
+            tags.append(tag)
+        elif subcmd == "untag" and tag in tags:
+            tags.remove(tag)
+        bot.config_store.set_room_setting(room.room_id, "tags", tags or None)
+        if subcmd == "tag":
+            bot.send_text(room.room_id, f"Raum erhält Rundsendungen an tag:{tag}.")
+        else:
+            bot.send_text(room.room_id, f"Raum aus tag:{tag} entfernt.")
+        return
+    
+    elif subcmd == "results":
+        try:
+            msg_id = int(subargs)
+        except ValueError:
+            bot.send_text(room.room_id, "Bitte gib eine gültige ID an.")
+            return
+        with broadcast_results_lock:
+            run = broadcast_results.get(msg_id)
+        if run is None or run.room_id != room.room_id:
+            bot.send_text(room.room_id, f"Keine Ergebnisse für Rundsendung {msg_id} vorhanden.")
+        else:
+            bot.send_text(room.room_id, format_broadcast_results(run))
+        return
+    
+    else:
+        bot.send_text(room.room_id, f"Unbekannter Unterbefehl: {subcmd}. !help für Hilfe.")
+
+# Scheduler anlegen, alle geplanten Nachrichten laden und die Scheduler-Threads starten
+def setup():
+    global message_scheduler, takeover_scheduler, broadcast_executor
+    message_scheduler = MessageScheduler(on_scheduled_message_due)
+    broadcast_executor = ThreadPoolExecutor(max_workers=bot.BROADCAST_PARALLELISM, thread_name_prefix="broadcast")
+    if bot.shard_coordinator is not None:
+        takeover_scheduler = MessageScheduler(on_takeover_due)
+    load_all_scheduled_messages()
+    
+    threading.Thread(target=message_scheduler.run, name="scheduler", daemon=True).start()
+    if takeover_scheduler is not None:
+        threading.Thread(target=takeover_scheduler.run, name="takeover", daemon=True).start()
+    bot.metrics.gauge("bot_scheduler_entries", lambda: len(message_scheduler))
+
+COMMANDS = {
+    "!schedule": handle_schedule_command,
+}
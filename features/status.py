@@ -0,0 +1,56 @@
+import time
+import bot
+
+# Status des Bots (!status)
+
+# Trefferquote eines Caches, sofern das Feature schon geladen ist
+def cache_hit_rate(feature_name, cache_name):
+    feature = bot.features.get(feature_name)
+    if feature is None:
+        return "nicht geladen"
+    cache = getattr(feature, cache_name)
+    return bot.hit_rate(cache.hits, cache.misses)
+
+# Zustand des Schutzschalters vor der KI-API
+def ai_backend_state():
+    feature = bot.features.get("ai")
+    if feature is None:
+        return "nicht geladen"
+    return feature.ai_breaker.describe()
+
+# !status: Laufzeit, Räume, Latenzen, Warteschlangen und Caches anzeigen
+def handle_status_command(room, sender, args):
+    joined_rooms = bot.config_store.joined_room_count()
+    room_average, room_total = bot.room_memory_estimate()
+    scheduled_msgs = bot.config_store.scheduled_message_count()
+    uptime = time.time() - bot.start_time
+    hours, remainder = divmod(uptime, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    ai_labels = {"stream": str(bot.AI_STREAMING).lower()}
+    recognize_labels = {"stage": "recognize"}
+    format_quantile = bot.format_quantile
+    shard_text = ""
+    if bot.shard_coordinator is not None:
+        owned_rooms = sum(1 for room_id in bot.config_store.joined_room_ids() if bot.shard_coordinator.owns_room(room_id))
+        shard_text = f"\nInstanz: {bot.shard_coordinator.shard_id} ({len(bot.shard_coordinator.live_shards)} aktiv, zuständig für {owned_rooms} Räume)"
+    
+    status_text = f"""**Bot-Status:**
+Bot aktiv seit: {int(hours)}h {int(minutes)}m {int(seconds)}s
+Räume: {joined_rooms} beigetreten, {len(bot.rooms)} im Speicher (~{room_average / 1024:.1f} KB pro Raum, ~{room_total / 1024 / 1024:.1f} MB)
+Geplante Nachrichten: {scheduled_msgs}{shard_text}
+Startdauer: {bot.startup_timer.total():.1f}s
+Geladene Features: {", ".join(bot.features) or "keine"}
+
+**Leistung (p50 / p95):**
+KI-Anfragen: {format_quantile("bot_ai_request_seconds", 0.5, ai_labels)} / {format_quantile("bot_ai_request_seconds", 0.95, ai_labels)}
+Transkription (Erkennung): {format_quantile("bot_transcribe_seconds", 0.5, recognize_labels)} / {format_quantile("bot_transcribe_seconds", 0.95, recognize_labels)}
+Event-Verzögerung: {format_quantile("bot_event_lag_seconds", 0.5)} / {format_quantile("bot_event_lag_seconds", 0.95)}
+Scheduler-Abweichung: {format_quantile("bot_scheduler_drift_seconds", 0.5)} / {format_quantile("bot_scheduler_drift_seconds", 0.95)}
+KI-Backend: {ai_backend_state()}
+Warteschlangen: {bot.executor.pending()} Befehle, {bot.outbound_sender.pending()} Nachrichten
+Cache-Trefferquote: KI {cache_hit_rate("ai", "ai_cache")}, Transkription {cache_hit_rate("transcription", "transcription_cache")}"""
+    bot.send_text(room.room_id, status_text)
+
+COMMANDS = {
+    "!status": handle_status_command,
+}
@@ -0,0 +1,337 @@
+import json
+import threading
+import subprocess
+import hashlib
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import speech_recognition as sr
+import bot
+
+# Transkription von Sprachnachrichten (!transcribe und automatische Transkription)
+
+transcription_cache = None
+chunk_executor = None
+
+# Fehler bei der Erkennung eines Abschnitts; partial enthält den bis dahin erkannten Text
+class TranscriptionError(Exception):
+    def __init__(self, message, partial=""):
+        super().__init__(message)
+        self.partial = partial
+
+# Transkriptionen nach Inhalts-Hash, mit Zuordnung mxc-URI -> Hash und LRU-Verdrängung
+class TranscriptionCache:
+    def __init__(self, max_entries=bot.TRANSCRIPTION_CACHE_SIZE, path=bot.TRANSCRIPTION_CACHE_FILE):
+        self.max_entries = max_entries
+        self.path = path
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.texts = OrderedDict()
+        self.mxc_hashes = OrderedDict()
+        self.in_flight = bot.SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.texts.update(data.get("texts", {}))
+            self.mxc_hashes.update(data.get("mxc", {}))
+            self._evict()
+
+    def save(self):
+        # Nacheinander speichern, damit kein älterer Stand einen neueren überschreibt
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps({"texts": self.texts, "mxc": self.mxc_hashes})
+            bot.write_json_atomic(self.path, data)
+
+    def get_by_mxc(self, mxc_url):
+        with self.lock:
+            content_hash = self.mxc_hashes.get(mxc_url)
+            if content_hash is None or content_hash not in self.texts:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.mxc_hashes.move_to_end(mxc_url)
+            self.texts.move_to_end(content_hash)
+            return self.texts[content_hash]
+
+    def get_by_hash(self, content_hash, mxc_url=None):
+        with self.lock:
+            text = self.texts.get(content_hash)
+            if text is None:
+                return None
+            self.hits += 1
+            self.texts.move_to_end(content_hash)
+            if mxc_url:
+                self.mxc_hashes[mxc_url] = content_hash
+                self.mxc_hashes.move_to_end(mxc_url)
+                self._evict()
+        return text
+
+    def put(self, content_hash, text, mxc_url=None):
+        with self.lock:
+            self.texts[content_hash] = text
+            self.texts.move_to_end(content_hash)
+            if mxc_url:
+                self.mxc_hashes[mxc_url] = content_hash
+                self.mxc_hashes.move_to_end(mxc_url)
+            self._evict()
+        if self.path:
+            self.save()
+
+    def _evict(self):
+        while len(self.texts) > self.max_entries:
+            self.texts.popitem(last=False)
+        # Weitergeleitete Dateien: mehrere mxc-URIs können auf denselben Hash zeigen
+        while len(self.mxc_hashes) > 2 * self.max_entries:
+            self.mxc_hashes.popitem(last=False)
+
+# Audio gestreamt herunterladen, höchstens max_bytes Bytes
+def download_audio(audio_url, max_bytes=bot.TRANSCRIBE_MAX_BYTES):
+    data = bytearray()
+    with bot.http_request("GET", audio_url, stream=True) as response:
+        response.raise_for_status()
+        content_length = response.headers.get("Content-Length")
+        if content_length and int(content_length) > max_bytes:
+            raise ValueError(f"Audiodatei zu groß ({int(content_length)} Bytes, erlaubt sind {max_bytes})")
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            data += chunk
+            if len(data) > max_bytes:
+                raise ValueError(f"Audiodatei zu groß (mehr als {max_bytes} Bytes)")
+    return bytes(data)
+
+SILENCE_PATTERN = re.compile(r"silence_(start|end): (-?[0-9.]+)")
+
+# Audio (z.B. OGG/Opus) im Speicher mit ffmpeg zu 16-Bit-Mono-PCM dekodieren.
+# Im selben Durchlauf meldet silencedetect die Pausen als Liste von (Anfang, Ende) in Sekunden.
+# Ein hängendes ffmpeg (z.B. bei einer präparierten Datei) wird nach einer von der Größe
+# abhängigen Zeit beendet, damit es keinen Worker dauerhaft blockiert.
+def decode_audio(data, sample_rate=bot.TRANSCRIBE_SAMPLE_RATE):
+    timeout = bot.FFMPEG_TIMEOUT + bot.FFMPEG_TIMEOUT_PER_MB * len(data) / (1024 * 1024)
+    try:
+        result = subprocess.run(
+            [bot.FFMPEG_BINARY, "-hide_banner", "-nostats", "-loglevel", "info",
+             "-i", "pipe:0",
+             "-af", f"silencedetect=noise={bot.TRANSCRIBE_SILENCE_DB}dB:d={bot.TRANSCRIBE_SILENCE_SECONDS}",
+             "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate),
+             "pipe:1"],
+            input=data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        raise TranscriptionError(f"Dekodierung nach {timeout:.0f}s abgebrochen")
+    log = result.stderr.decode(errors="replace")
+    if result.returncode != 0:
+        errors = [line for line in log.splitlines() if "silence_" not in line]
+        raise RuntimeError(f"Dekodierung fehlgeschlagen: {errors[-1].strip() if errors else result.returncode}")
+    
+    silences = []
+    start = None
+    for kind, value in SILENCE_PATTERN.findall(log):
+        if kind == "start":
+            start = max(float(value), 0.0)
+        elif start is not None:
+            silences.append((start, float(value)))
+            start = None
+    return sr.AudioData(result.stdout, sample_rate, 2), silences
+
+# Schnittpunkte für lange Aufnahmen: in der Mitte einer Pause, sobald ein Abschnitt
+# mindestens ein Drittel der Höchstlänge hat, sonst hart bei max_seconds.
+# Gibt eine Liste von (Anfang, Ende) in Sekunden zurück.
+def chunk_bounds(duration, silences, max_seconds=bot.TRANSCRIBE_CHUNK_SECONDS):
+    bounds = []
+    start = 0.0
+    cuts = [(silence_start + silence_end) / 2 for silence_start, silence_end in silences]
+    while duration - start > max_seconds:
+        candidates = [cut for cut in cuts if start + max_seconds / 3 <= cut <= start + max_seconds]
+        end = candidates[-1] if candidates else start + max_seconds
+        bounds.append((start, end))
+        start = end
+    bounds.append((start, duration))
+    return bounds
+
+# Erkennungs-Backends: Funktion(recognizer, audio_data, language) -> Text
+def recognize_with_google(recognizer, audio_data, language):
+    return recognizer.recognize_google(audio_data, language=language)
+
+def recognize_with_sphinx(recognizer, audio_data, language):
+    return recognizer.recognize_sphinx(audio_data, language=language)
+
+def recognize_with_whisper(recognizer, audio_data, language):
+    return recognizer.recognize_whisper(audio_data, language=language.split("-")[0])
+
+RECOGNIZER_BACKENDS = {
+    "google": recognize_with_google,
+    "sphinx": recognize_with_sphinx,
+    "whisper": recognize_with_whisper,
+}
+
+# Eigenes Erkennungs-Backend registrieren
+def register_recognizer(name, func):
+    RECOGNIZER_BACKENDS[name] = func
+
+# PCM-Audio in Text umwandeln
+def recognize_audio(audio_data, backend=None, language=bot.TRANSCRIBE_LANGUAGE):
+    recognize = RECOGNIZER_BACKENDS[backend or bot.RECOGNIZER_BACKEND]
+    return recognize(sr.Recognizer(), audio_data, language)
+
+# Einen Abschnitt erkennen; Abschnitte ohne erkennbare Sprache ergeben leeren Text
+def recognize_chunk(audio_data, backend):
+    try:
+        return recognize_audio(audio_data, backend)
+    except sr.UnknownValueError:
+        return ""
+    finally:
+        bot.metrics.inc("bot_transcribe_chunks_total")
+
+# Lange Aufnahme an Pausen zerlegen, Abschnitte parallel erkennen und in Reihenfolge zusammensetzen.
+# on_partial erhält nach jedem fertigen Abschnitt den lückenlos erkannten Anfang.
+def recognize_chunks(audio_data, silences, backend=None, on_partial=None):
+    bytes_per_second = audio_data.sample_rate * audio_data.sample_width
+    duration = len(audio_data.frame_data) / bytes_per_second
+    bounds = chunk_bounds(duration, silences)
+    futures = []
+    for start, end in bounds:
+        # Auf ganze Samples runden, damit kein Abschnitt mitten in einem Sample beginnt
+        first = int(start * audio_data.sample_rate) * audio_data.sample_width
+        last = int(end * audio_data.sample_rate) * audio_data.sample_width
+        chunk = sr.AudioData(audio_data.frame_data[first:last], audio_data.sample_rate, audio_data.sample_width)
+        futures.append(chunk_executor.submit(recognize_chunk, chunk, backend))
+    
+    texts = [None] * len(futures)
+    condition = threading.Condition()
+    def on_done(index, future):
+        with condition:
+            texts[index] = future
+            condition.notify()
+    for index, future in enumerate(futures):
+        future.add_done_callback(lambda future, index=index: on_done(index, future))
+    
+    parts = []
+    done = 0
+    while len(parts) < len(futures):
+        with condition:
+            while texts[len(parts)] is None:
+                condition.wait()
+            done = sum(1 for text in texts if text is not None)
+            finished = texts[len(parts)]
+        try:
+            parts.append(finished.result())
+        except Exception as e:
+            for future in futures:
+                future.cancel()
+            raise TranscriptionError(f"Abschnitt {len(parts) + 1}/{len(futures)}: {str(e)}", partial=join_parts(parts))
+        if on_partial is not None and len(parts) < len(futures):
+            on_partial(f"{join_parts(parts)} … ({done}/{len(futures)})".lstrip())
+    return join_parts(parts)
+
+def join_parts(parts):
+    return " ".join(part for part in parts if part)
+
+# Bereits heruntergeladene Audiodaten transkribieren
+def transcribe_bytes(data, backend=None, on_partial=None):
+    with bot.metrics.timer("bot_transcribe_seconds", {"stage": "decode"}):
+        audio_data, silences = decode_audio(data)
+    duration = len(audio_data.frame_data) / (audio_data.sample_rate * audio_data.sample_width)
+    with bot.metrics.timer("bot_transcribe_seconds", {"stage": "recognize"}):
+        if duration <= bot.TRANSCRIBE_LONG_AUDIO_SECONDS:
+            return recognize_audio(audio_data, backend)
+        return recognize_chunks(audio_data, silences, backend, on_partial)
+
+# Audio-Transkription ohne temporäre Dateien:
+# Download im Speicher, Dekodierung über Pipes, PCM direkt an die Erkennung.
+# Ergebnisse werden nach mxc-URI und Inhalts-Hash zwischengespeichert.
+# Bei langen Aufnahmen erhält on_partial den bisher erkannten Text.
+def transcribe_audio(audio_url, mxc_url=None, on_partial=None):
+    try:
+        if mxc_url:
+            cached = transcription_cache.get_by_mxc(mxc_url)
+            if cached is not None:
+                return cached
+        return transcription_cache.in_flight.do(("url", mxc_url or audio_url), transcribe_uncached, audio_url, mxc_url, on_partial)
+    except TranscriptionError as e:
+        # Unvollständige Ergebnisse werden angezeigt, aber nicht zwischengespeichert
+        if e.partial:
+            return e.partial + f" [unvollständig: {str(e)}]"
+        return f"Transkription fehlgeschlagen: {str(e)}"
+    except Exception as e:
+        return f"Transkription fehlgeschlagen: {str(e)}"
+
+# Herunterladen und erkennen, falls der Inhalt noch nicht bekannt ist
+def transcribe_uncached(audio_url, mxc_url, on_partial=None):
+    with bot.metrics.timer("bot_transcribe_seconds", {"stage": "download"}):
+        data = download_audio(audio_url)
+    content_hash = hashlib.sha256(data).hexdigest()
+    text = transcription_cache.get_by_hash(content_hash, mxc_url)
+    if text is None:
+        # Gleicher Inhalt unter verschiedenen mxc-URIs wird nur einmal erkannt
+        text = transcription_cache.in_flight.do(("sha256", content_hash), transcribe_bytes, data, None, on_partial)
+        transcription_cache.put(content_hash, text, mxc_url)
+    return text
+
+# !transcribe: letzte Sprachnachricht des Raums transkribieren
+def handle_transcribe_command(room, sender, args):
+    bot.send_text(room.room_id, "Suche nach der letzten Sprachnachricht...", status=True)
+    try:
+        # Nachrichten aus dem Raumverlauf abrufen (die letzten 50)
+        room_events = bot.get_recent_room_events(room, 50, bot.is_audio_event)
+        
+        # Nach Sprachnachrichten suchen (neueste zuerst)
+        audio_events = [event for event in reversed(room_events) if bot.is_audio_event(event)]
+        
+        if not audio_events:
+            bot.send_text(room.room_id, "Keine Sprachnachrichten in den letzten 50 Nachrichten gefunden.")
+            return
+        
+        # Die neueste Sprachnachricht verwenden
+        latest_audio = audio_events[0]
+        mxc_url = latest_audio['content'].get('url')
+        
+        if mxc_url:
+            # MXC-URL in HTTP-URL umwandeln
+            http_url = bot.client.api.get_download_url(mxc_url)
+            bot.send_text(room.room_id, "Transkribiere Sprachnachricht...", status=True)
+            reply = bot.StreamingReply(room.room_id, "Transkription: ")
+            transcription = transcribe_audio(http_url, mxc_url, on_partial=reply.update)
+            reply.finish(transcription)
+        else:
+            bot.send_text(room.room_id, "Fehler: Keine URL für die Audiodatei gefunden.")
+    except Exception as e:
+        bot.send_text(room.room_id, f"Fehler beim Zugriff auf den Raumverlauf: {str(e)}")
+        import traceback
+        traceback.print_exc()  # Detaillierteren Fehler in der Konsole ausgeben
+
+# Sprachnachricht in einem Raum mit automatischer Transkription
+def handle_audio_message(room, event):
+    mxc_url = event['content'].get('url')
+    if mxc_url:
+        bot.send_text(room.room_id, "Transkribiere Sprachnachricht...", status=True)
+        # MXC-URL in HTTP-URL umwandeln
+        http_url = bot.client.api.get_download_url(mxc_url)
+        reply = bot.StreamingReply(room.room_id, "Transkription: ")
+        with bot.metrics.timer("bot_command_seconds", {"command": "auto_transcribe"}):
+            transcription = transcribe_audio(http_url, mxc_url, on_partial=reply.update)
+        bot.metrics.inc("bot_commands_total", {"command": "auto_transcribe"})
+        reply.finish(transcription)
+
+# Cache anlegen (lädt TRANSCRIPTION_CACHE_FILE, falls gesetzt) und Messwerte registrieren
+def setup():
+    global transcription_cache, chunk_executor
+    transcription_cache = TranscriptionCache()
+    chunk_executor = ThreadPoolExecutor(max_workers=bot.TRANSCRIBE_WORKERS, thread_name_prefix="transcribe")
+    bot.metrics.gauge("bot_transcription_cache_hits", lambda: transcription_cache.hits)
+    bot.metrics.gauge("bot_transcription_cache_misses", lambda: transcription_cache.misses)
+
+COMMANDS = {
+    "!transcribe": handle_transcribe_command,
+}